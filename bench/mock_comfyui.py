@@ -0,0 +1,305 @@
+"""Stand-in ComfyUI server for benchmarking handler.py without a GPU.
+
+Implements the parts of the ComfyUI API the handler talks to: /system_stats,
+/prompt, /queue, /interrupt, /history, /view, /object_info and the /ws event
+stream (status, execution_start, executing, progress, executed,
+execution_success/error/interrupted, plus the binary result frames of the
+faceswap_io WebSocket output node). Prompts run one at a time like in
+ComfyUI; each node just sleeps for its configured delay.
+
+    python bench/mock_comfyui.py --port 8188 --node-delay KSampler=0.5 --image-size 1024x1024
+"""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+import uuid
+import zlib
+
+from aiohttp import web, WSCloseCode, WSMsgType
+
+FACESWAP_IMAGE_EVENT = 0x46530001  # Must match handler.py / custom_nodes/faceswap_io
+OUTPUT_CLASSES = {"SaveImage", "PreviewImage", "FaceSwapSendImageWebSocket"}
+CUSTOM_NODE_CLASSES = {"FaceSwapLoadImageBase64", "FaceSwapLoadImageSharedMemory", "FaceSwapSendImageWebSocket"}
+
+
+def make_png(width, height, seed=0):
+    """Encode a valid RGB PNG of the given size (noise, so it doesn't compress away)."""
+    rng = random.Random(seed)
+    row = bytes(rng.getrandbits(8) for _ in range(width * 3))
+    raw = b"".join(b"\x00" + row for _ in range(height))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+def execution_order(prompt):
+    """Topological order of the prompt's nodes (dependencies first)."""
+    order, seen = [], set()
+
+    def visit(node_id):
+        if node_id in seen or node_id not in prompt:
+            return
+        seen.add(node_id)
+        for value in prompt[node_id].get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                visit(value[0])
+        order.append(node_id)
+
+    for node_id in prompt:
+        visit(node_id)
+    return order
+
+
+class MockComfyUI:
+    def __init__(self, args):
+        self.args = args
+        self.node_delays = dict(args.node_delay)
+        self.image = make_png(*args.image_size)
+        self.sockets = {}
+        self.queue = asyncio.Queue()
+        self.pending = {}
+        self.running = None
+        self.interrupted = set()
+        self.history = {}
+        self.number = 0
+        self.last_outputs = {}
+        self.rng = random.Random(args.seed)
+
+    # --- WebSocket -------------------------------------------------------
+    async def send(self, client_id, msg_type, data):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps({"type": msg_type, "data": data}))
+
+    async def send_status(self, client_id=None):
+        data = {"status": {"exec_info": {"queue_remaining": len(self.pending) + (self.running is not None)}}}
+        targets = [client_id] if client_id else list(self.sockets)
+        for target in targets:
+            await self.send(target, "status", data)
+
+    async def ws_handler(self, request):
+        client_id = request.query.get("clientId") or uuid.uuid4().hex
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self.sockets[client_id] = ws
+        await self.send(client_id, "status", {"status": {"exec_info": {"queue_remaining": len(self.pending)}}, "sid": client_id})
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+        if self.sockets.get(client_id) is ws:
+            del self.sockets[client_id]
+        return ws
+
+    # --- HTTP ------------------------------------------------------------
+    async def system_stats(self, request):
+        return web.json_response({
+            "system": {"os": "mock", "ram_total": 64 << 30, "ram_free": 32 << 30, "comfyui_version": "mock"},
+            "devices": [{"name": "mock-gpu", "type": "cuda", "vram_total": 24 << 30, "vram_free": 20 << 30}],
+        })
+
+    async def post_prompt(self, request):
+        payload = await request.json()
+        if self.rng.random() < self.args.reject_rate:
+            return web.json_response({"error": {"type": "mock_rejected", "message": "Injected rejection"}, "node_errors": {}}, status=400)
+        prompt_id = str(payload.get("prompt_id") or uuid.uuid4())
+        self.number += 1
+        item = [self.number, prompt_id, payload["prompt"], {"client_id": payload.get("client_id")}, []]
+        self.pending[prompt_id] = item
+        await self.queue.put(item)
+        await self.send_status()
+        return web.json_response({"prompt_id": prompt_id, "number": self.number, "node_errors": {}})
+
+    async def get_queue(self, request):
+        return web.json_response({
+            "queue_running": [self.running] if self.running else [],
+            "queue_pending": list(self.pending.values()),
+        })
+
+    async def post_queue(self, request):
+        payload = await request.json()
+        if payload.get("clear"):
+            self.pending.clear()
+        for prompt_id in payload.get("delete", []):
+            self.pending.pop(prompt_id, None)
+        return web.Response()
+
+    async def interrupt(self, request):
+        payload = await request.json() if request.can_read_body else {}
+        target = payload.get("prompt_id") if isinstance(payload, dict) else None
+        if self.running and (target is None or target == self.running[1]):
+            self.interrupted.add(self.running[1])
+        return web.Response()
+
+    async def get_history(self, request):
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id:
+            return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+        return web.json_response(self.history)
+
+    async def post_history(self, request):
+        payload = await request.json()
+        if payload.get("clear"):
+            self.history.clear()
+        for prompt_id in payload.get("delete", []):
+            self.history.pop(prompt_id, None)
+        return web.Response()
+
+    async def view(self, request):
+        return web.Response(body=self.image, content_type="image/png")
+
+    async def object_info(self, request):
+        node_class = request.match_info["node_class"]
+        if self.args.custom_nodes and node_class in CUSTOM_NODE_CLASSES:
+            return web.json_response({node_class: {"name": node_class}})
+        return web.json_response({})
+
+    # --- Execution -------------------------------------------------------
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            number, prompt_id, prompt, extra, _ = item
+            if self.pending.pop(prompt_id, None) is None:
+                continue  # Supprimé de la file via POST /queue
+            self.running = item
+            try:
+                await self.execute(prompt_id, prompt, extra.get("client_id"))
+            finally:
+                self.running = None
+                self.interrupted.discard(prompt_id)
+                await self.send_status()
+
+    async def execute(self, prompt_id, prompt, client_id):
+        started = time.time()
+        await self.send(client_id, "execution_start", {"prompt_id": prompt_id, "timestamp": int(started * 1000)})
+        order = execution_order(prompt)
+        # Comme ComfyUI: un node dont les entrées n'ont pas changé depuis le prompt précédent est en cache
+        cached = [node_id for node_id in order
+                  if self.args.cache and prompt[node_id]["class_type"] not in OUTPUT_CLASSES
+                  and self.last_outputs.get(node_id) == json.dumps(prompt[node_id], sort_keys=True)]
+        if cached:
+            await self.send(client_id, "execution_cached", {"nodes": cached, "prompt_id": prompt_id})
+        fail_node = order[len(order) // 2] if self.rng.random() < self.args.fail_rate else None
+        outputs = {}
+        for node_id in order:
+            if node_id in cached:
+                continue
+            if prompt_id in self.interrupted:
+                await self.send(client_id, "execution_interrupted", {"prompt_id": prompt_id, "node_id": node_id})
+                self.record(prompt_id, prompt, outputs, "error", started)
+                return
+            node = prompt[node_id]
+            class_type = node["class_type"]
+            await self.send(client_id, "executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+            if node_id == fail_node:
+                await self.send(client_id, "execution_error", {
+                    "prompt_id": prompt_id, "node_id": node_id, "node_type": class_type,
+                    "exception_message": "Injected failure", "exception_type": "RuntimeError", "traceback": [],
+                })
+                self.record(prompt_id, prompt, outputs, "error", started)
+                return
+            delay = self.node_delays.get(class_type, self.args.default_node_delay)
+            steps = int(node["inputs"].get("steps", 0)) if class_type == "KSampler" else 0
+            if steps:
+                for step in range(1, steps + 1):
+                    await asyncio.sleep(delay / steps)
+                    await self.send(client_id, "progress", {"value": step, "max": steps, "prompt_id": prompt_id, "node": node_id})
+            elif delay:
+                await asyncio.sleep(delay)
+            self.last_outputs[node_id] = json.dumps(node, sort_keys=True)
+            if class_type in ("SaveImage", "PreviewImage"):
+                image = {"filename": f"{prompt_id}_{node_id}_00001_.png", "subfolder": "",
+                         "type": "output" if class_type == "SaveImage" else "temp"}
+                outputs[node_id] = {"images": [image]}
+                await self.send(client_id, "executed", {"node": node_id, "display_node": node_id,
+                                                        "output": outputs[node_id], "prompt_id": prompt_id})
+            elif class_type == "FaceSwapSendImageWebSocket":
+                await self.send_image_frame(client_id, prompt_id, node_id)
+        await self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+        await self.send(client_id, "execution_success", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)})
+        self.record(prompt_id, prompt, outputs, "success", started)
+
+    async def send_image_frame(self, client_id, prompt_id, node_id):
+        ws = self.sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        header = json.dumps({"prompt_id": prompt_id, "node": node_id, "index": 0, "format": "png"}).encode("utf-8")
+        await ws.send_bytes(struct.pack(">I", FACESWAP_IMAGE_EVENT) + struct.pack(">I", len(header)) + header + self.image)
+
+    def record(self, prompt_id, prompt, outputs, status, started):
+        self.history[prompt_id] = {
+            "prompt": [0, prompt_id, prompt, {}, []],
+            "outputs": outputs,
+            "status": {"status_str": status, "completed": status == "success", "messages": []},
+        }
+        while len(self.history) > self.args.max_history:
+            self.history.pop(next(iter(self.history)))
+
+    def app(self):
+        app = web.Application(client_max_size=256 << 20)
+        app.add_routes([
+            web.get("/ws", self.ws_handler),
+            web.get("/system_stats", self.system_stats),
+            web.post("/prompt", self.post_prompt),
+            web.get("/queue", self.get_queue),
+            web.post("/queue", self.post_queue),
+            web.post("/interrupt", self.interrupt),
+            web.get("/history", self.get_history),
+            web.get("/history/{prompt_id}", self.get_history),
+            web.post("/history", self.post_history),
+            web.get("/view", self.view),
+            web.get("/object_info/{node_class}", self.object_info),
+        ])
+
+        async def start_worker(app):
+            app["worker"] = asyncio.create_task(self.worker())
+
+        async def close_sockets(app):
+            # Le handler garde son WebSocket ouvert: sans ça, l'arrêt attend son timeout
+            for ws in list(self.sockets.values()):
+                await ws.close(code=WSCloseCode.GOING_AWAY, message=b"Server shutdown")
+
+        app.on_startup.append(start_worker)
+        app.on_shutdown.append(close_sockets)
+        return app
+
+
+def parse_delay(value):
+    class_type, _, seconds = value.partition("=")
+    return class_type, float(seconds)
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--default-node-delay", type=float, default=0.0, help="Seconds per node")
+    parser.add_argument("--node-delay", type=parse_delay, action="append", default=[],
+                        metavar="CLASS=SECONDS", help="Per class_type delay, e.g. KSampler=0.5")
+    parser.add_argument("--image-size", type=parse_size, default=(512, 512), metavar="WxH")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of prompts failing mid-graph")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Fraction of /prompt calls answered 400")
+    parser.add_argument("--custom-nodes", action="store_true", help="Advertise the faceswap_io nodes")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", help="Disable node-output caching")
+    parser.add_argument("--max-history", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    web.run_app(MockComfyUI(args).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
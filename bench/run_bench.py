@@ -0,0 +1,202 @@
+"""Offline throughput/latency benchmark of handler.py against mock_comfyui.py.
+
+Starts the mock ComfyUI server(s) in subprocesses, points the handler's
+instance pool at them (COMFYUI_EXTERNAL=1) and drives `handler()` at several concurrency levels
+and batch sizes. Reports jobs/sec, pairs/sec, latency percentiles, peak RSS
+of the handler process and response payload sizes, so orchestration
+changes can be measured on a plain CPU box. The RSS column is cumulative
+(ru_maxrss never decreases): each row shows the peak of the run so far,
+not of that level alone.
+
+    python bench/run_bench.py --concurrency 1,4,8 --batch-sizes 1,8 --jobs 32 \
+        --mock-arg=--node-delay=KSampler=0.2 --mock-arg=--image-size=1024x1024
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(port, mock_args):
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "mock_comfyui.py"), "--port", str(port), *mock_args])
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Mock ComfyUI exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/system_stats", timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock ComfyUI did not become ready")
+
+
+def stop_mock(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))]
+
+
+def make_job(args, batch_size, index):
+    job_input = {"workflow": args.workflow, "use_cache": args.result_cache}
+    if args.params:
+        job_input["params"] = json.loads(args.params)
+    if args.output:
+        job_input["output"] = json.loads(args.output)
+    if args.quality:
+        job_input["quality"] = args.quality
+    if batch_size == 1:
+        job_input.update({"image1_path": args.image1, "image2_path": args.image2})
+    else:
+        job_input.update({"image1_path": args.image1, "targets": [args.image2] * batch_size})
+    return {"id": f"bench-{batch_size}-{index}", "input": job_input}
+
+
+async def run_level(handler, args, concurrency, batch_size):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, payload_bytes, statuses = [], [], {}
+
+    async def one(index):
+        async with semaphore:
+            start = time.perf_counter()
+            result = await handler.handler(make_job(args, batch_size, index))
+            latencies.append(time.perf_counter() - start)
+            payload_bytes.append(len(json.dumps(result)))
+            statuses[result.get("status")] = statuses.get(result.get("status"), 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(args.jobs)))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "jobs": args.jobs,
+        "elapsed_s": round(elapsed, 3),
+        "jobs_per_sec": round(args.jobs / elapsed, 3),
+        "pairs_per_sec": round(args.jobs * batch_size / elapsed, 3),
+        "latency_ms": {q: round(percentile(latencies, p) * 1000, 1)
+                       for q, p in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+        "payload_bytes": {"mean": int(sum(payload_bytes) / len(payload_bytes)), "max": max(payload_bytes)},
+        # ru_maxrss: pic depuis le démarrage du process, pas celui de ce niveau
+        "cumulative_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "statuses": statuses,
+    }
+
+
+def print_table(rows):
+    header = f"{'conc':>4} {'batch':>5} {'jobs/s':>8} {'pairs/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'payload':>10} {'cum rss':>7}  statuses"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        latency = row["latency_ms"]
+        print(f"{row['concurrency']:>4} {row['batch_size']:>5} {row['jobs_per_sec']:>8} {row['pairs_per_sec']:>8} "
+              f"{latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9} {row['payload_bytes']['mean']:>10} "
+              f"{row['cumulative_peak_rss_mb']:>7}  {row['statuses']}")
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int_list, default=[1, 2, 4, 8], help="Comma-separated levels")
+    parser.add_argument("--batch-sizes", type=int_list, default=[1], help="Comma-separated pairs per job")
+    parser.add_argument("--jobs", type=int, default=20, help="Jobs per (concurrency, batch size) level")
+    parser.add_argument("--workflow", default=None, help="Workflow name (default: handler default)")
+    parser.add_argument("--params", default=None, help="JSON workflow params, e.g. '{\"steps\": 4}'")
+    parser.add_argument("--output", default=None,
+                        help="JSON output options, e.g. '{\"format\": \"webp\", \"quality\": 80, \"mode\": \"reference\"}'")
+    parser.add_argument("--quality", default=None, help="Quality tier (preview/standard/max)")
+    parser.add_argument("--image1", default=os.path.join(REPO_DIR, "images", "input.jpg"))
+    parser.add_argument("--image2", default=os.path.join(REPO_DIR, "images", "target.jpg"))
+    parser.add_argument("--transport", default="file", choices=["file", "base64", "shm"],
+                        help="IMAGE_TRANSPORT for the handler (base64/shm imply --mock-arg=--custom-nodes)")
+    parser.add_argument("--result-cache", action="store_true", help="Keep the handler's result cache enabled")
+    parser.add_argument("--instances", type=int, default=1, help="Mock ComfyUI instances in the handler's pool")
+    parser.add_argument("--mock-arg", action="append", default=[], help="Extra argument for mock_comfyui.py")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the handler's logs")
+    args = parser.parse_args()
+
+    mock_args = list(args.mock_arg)
+    if args.transport != "file" and "--custom-nodes" not in mock_args:
+        mock_args.append("--custom-nodes")
+    ports = [free_port() for _ in range(args.instances)]
+    mocks = []
+    try:
+        for port in ports:
+            mocks.append(start_mock(port, mock_args))
+    except Exception:
+        for mock in mocks:
+            stop_mock(mock)
+        raise
+
+    os.environ.update({
+        "COMFYUI_HOST": ",".join(f"127.0.0.1:{port}" for port in ports),
+        "COMFYUI_EXTERNAL": "1",
+        "EAGER_BOOT": "0",
+        "IMAGE_TRANSPORT": args.transport,
+        "RESULT_CACHE_ENABLED": "1" if args.result_cache else "0",
+        "RESULT_CACHE_DIR": os.environ.get("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "faceswap-bench-cache")),
+        "OUTPUT_STORE_DIR": os.environ.get("OUTPUT_STORE_DIR", os.path.join(tempfile.gettempdir(), "faceswap-bench-outputs")),
+        "SOURCE_CACHE_DIR": os.environ.get("SOURCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "faceswap-bench-sources")),
+        "MAX_CONCURRENCY": str(max(args.concurrency)),
+    })
+    os.chdir(REPO_DIR)
+    sys.path.insert(0, REPO_DIR)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stderr(open(os.devnull, "w"))
+    rows = []
+    try:
+        with quiet:
+            import handler
+            if not args.verbose:
+                handler.logger.setLevel(logging.WARNING)
+            for batch_size in args.batch_sizes:
+                for concurrency in args.concurrency:
+                    rows.append(asyncio.run(run_level(handler, args, concurrency, batch_size)))
+            metrics = handler.job_metrics.snapshot()
+        # Résultats écrits avant l'arrêt des mocks: un arrêt lent ne doit pas les perdre
+        print_table(rows)
+        print("\nHandler stage latencies (all levels):")
+        for stage, stats in sorted(metrics["stages_ms"].items()):
+            print(f"  {stage:<14} p50={stats['p50']:>9} p95={stats['p95']:>9} p99={stats['p99']:>9} ms  (n={stats['count']})")
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as f:
+                json.dump({"levels": rows, "handler_metrics": metrics}, f, indent=2)
+    finally:
+        for mock in mocks:
+            stop_mock(mock)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""In-memory image I/O nodes for the faceswap RunPod handler.
+
+The handler rewrites the workflow's LoadImage/SaveImage nodes to these so no
+image touches the disk: inputs arrive as base64 in the prompt or as a
+shared-memory segment written by the handler, and results are sent back as
+binary WebSocket frames instead of PNG files fetched through /view.
+"""
+import base64
+import hashlib
+import io
+import json
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+import server
+
+# Binary WebSocket event type for result images (must match handler.py).
+# Frame layout after ComfyUI's 4-byte event type: >I header length, JSON
+# header {"prompt_id", "node", "index", "format"}, then the encoded image.
+FACESWAP_IMAGE_EVENT = 0x46530001
+
+
+def decode_image(data):
+    """Decode encoded image bytes into ComfyUI (IMAGE, MASK) tensors, like LoadImage."""
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    if img.mode == "I":
+        img = img.point(lambda i: i * (1 / 255))
+    image = np.array(img.convert("RGB")).astype(np.float32) / 255.0
+    image = torch.from_numpy(image)[None,]
+    if "A" in img.getbands():
+        mask = np.array(img.getchannel("A")).astype(np.float32) / 255.0
+        mask = 1. - torch.from_numpy(mask)
+    else:
+        mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+    return (image, mask.unsqueeze(0))
+
+
+def read_shared_memory(shm_name, size):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # The handler owns the segment: don't let our resource tracker unlink it
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+class FaceSwapLoadImageBase64:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"data": ("STRING", {"multiline": False})}}
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    FUNCTION = "load_image"
+    CATEGORY = "faceswap/io"
+
+    def load_image(self, data):
+        return decode_image(base64.b64decode(data))
+
+    @classmethod
+    def IS_CHANGED(s, data):
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class FaceSwapLoadImageSharedMemory:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "shm_name": ("STRING", {"multiline": False}),
+            "size": ("INT", {"default": 0, "min": 0, "max": 0x7FFFFFFF}),
+        }}
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    FUNCTION = "load_image"
+    CATEGORY = "faceswap/io"
+
+    def load_image(self, shm_name, size):
+        return decode_image(read_shared_memory(shm_name, size))
+
+    @classmethod
+    def IS_CHANGED(s, shm_name, size):
+        # Segments are named after the content hash of the image they hold
+        return f"{shm_name}:{size}"
+
+
+class FaceSwapSendImageWebSocket:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "images": ("IMAGE",),
+                "format": (["PNG", "JPEG", "WEBP"], {"default": "PNG"}),
+                "quality": ("INT", {"default": 95, "min": 1, "max": 100}),
+            },
+            "optional": {
+                # Longest side of the sent image, 0 = unchanged
+                "max_dim": ("INT", {"default": 0, "min": 0, "max": 16384}),
+            },
+            "hidden": {"unique_id": "UNIQUE_ID"},
+        }
+
+    RETURN_TYPES = ()
+    FUNCTION = "send_images"
+    OUTPUT_NODE = True
+    CATEGORY = "faceswap/io"
+
+    def send_images(self, images, format="PNG", quality=95, max_dim=0, unique_id=None):
+        prompt_server = server.PromptServer.instance
+        for index, image in enumerate(images):
+            array = np.clip(255. * image.cpu().numpy(), 0, 255).astype(np.uint8)
+            img = Image.fromarray(array)
+            if max_dim and max(img.size) > max_dim:
+                img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            if format == "PNG":
+                img.save(buffer, format="PNG", compress_level=4)
+            else:
+                img.save(buffer, format=format, quality=quality)
+            header = json.dumps({
+                "prompt_id": prompt_server.last_prompt_id,
+                "node": unique_id,
+                "index": index,
+                "format": format.lower(),
+            }).encode("utf-8")
+            payload = struct.pack(">I", len(header)) + header + buffer.getvalue()
+            prompt_server.send_sync(FACESWAP_IMAGE_EVENT, payload, prompt_server.client_id)
+        return {}
+
+    @classmethod
+    def IS_CHANGED(s, **kwargs):
+        # Always re-run: a cached output node would not send its frames again
+        return float("NaN")
+
+
+NODE_CLASS_MAPPINGS = {
+    "FaceSwapLoadImageBase64": FaceSwapLoadImageBase64,
+    "FaceSwapLoadImageSharedMemory": FaceSwapLoadImageSharedMemory,
+    "FaceSwapSendImageWebSocket": FaceSwapSendImageWebSocket,
+}
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "FaceSwapLoadImageBase64": "Load Image (base64)",
+    "FaceSwapLoadImageSharedMemory": "Load Image (shared memory)",
+    "FaceSwapSendImageWebSocket": "Send Image (WebSocket)",
+}
@@ -5,8 +5,9 @@ sys.stderr.flush()
 
 import runpod
 import json
-import urllib.request
 import urllib.parse
+import http.client
+import socket
 import uuid
 import websocket
 import base64
@@ -16,7 +17,24 @@ import os
 import signal
 import logging
 import traceback
+import hashlib
+import io
+import re
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import struct
+import threading
+import queue
+import asyncio
+import abc
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Optional
+from PIL import Image, ImageChops, ImageOps
 
 # Logging setup
 logging.basicConfig(
@@ -28,104 +46,1225 @@ logger = logging.getLogger("comfyui-faceswap")
 
 # Config
 WORKFLOW_PATH = os.environ.get("WORKFLOW_PATH", "good.json")
+WORKFLOWS = os.environ.get("WORKFLOWS", "good=good.json,faceswap=workflow_faceswap.json")  # Workflows nommés, choisis par requête
+WORKFLOW_RELOAD_INTERVAL = float(os.environ.get("WORKFLOW_RELOAD_INTERVAL", "5"))
 COMFYUI_HOST = os.environ.get("COMFYUI_HOST", "127.0.0.1:8188")
 NETWORK_STORAGE_PATH = os.environ.get("NETWORK_STORAGE_PATH", "/runpod-volume")
 COMFYUI_TIMEOUT = int(os.environ.get("COMFYUI_TIMEOUT", "120"))  # Augmenté à 120 secondes
 COMFYUI_PATH = os.environ.get("COMFYUI_PATH", "/ComfyUI")  # Chemin vers l'installation de ComfyUI
+COMFYUI_EXTERNAL = os.environ.get("COMFYUI_EXTERNAL", "0") == "1"  # ComfyUI déjà lancé ailleurs (docker-compose, benchmarks); COMFYUI_HOST peut lister plusieurs hôtes séparés par des virgules
+COMFYUI_INSTANCES = int(os.environ.get("COMFYUI_INSTANCES", "1"))  # Nombre de process ComfyUI lancés par le worker
+COMFYUI_BASE_PORT = int(os.environ.get("COMFYUI_BASE_PORT", "8188"))  # L'instance i écoute sur COMFYUI_BASE_PORT + i
+COMFYUI_DEVICES = os.environ.get("COMFYUI_DEVICES", "cpu")  # "cpu" ou index CUDA séparés par des virgules, ex: "0,1" (répartis en round-robin)
+COMFYUI_AFFINITY_SLACK = float(os.environ.get("COMFYUI_AFFINITY_SLACK", "1"))  # Prompts d'avance acceptés pour rester sur une instance au cache chaud
+COMFYUI_MONITOR_INTERVAL = float(os.environ.get("COMFYUI_MONITOR_INTERVAL", "2"))  # Période des sondes de santé du superviseur
+COMFYUI_RESTART_DELAY = float(os.environ.get("COMFYUI_RESTART_DELAY", "10"))  # Délai min entre deux tentatives de démarrage d'une instance
+COMFYUI_RESTART_MAX_DELAY = float(os.environ.get("COMFYUI_RESTART_MAX_DELAY", "300"))  # Plafond du backoff (doublé à chaque échec de démarrage)
+COMFYUI_PROBE_TIMEOUT = float(os.environ.get("COMFYUI_PROBE_TIMEOUT", "5"))  # Timeout d'une sonde /system_stats
+COMFYUI_HUNG_TIMEOUT = float(os.environ.get("COMFYUI_HUNG_TIMEOUT", "120"))  # API muette depuis N s alors que le process vit: tué puis relancé (0 = jamais)
+COMFYUI_RESTART_HOLD = float(os.environ.get("COMFYUI_RESTART_HOLD", "60"))  # Attente max d'un job pendant le redémarrage des instances
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "4"))  # Jobs en parallèle par worker
+EXECUTION_TIMEOUT = int(os.environ.get("EXECUTION_TIMEOUT", "300"))  # Délai par défaut d'un job (5 min), surchargeable par requête via "timeout"
+COMFYUI_HTTP_TIMEOUT = float(os.environ.get("COMFYUI_HTTP_TIMEOUT", "30"))  # Timeout des appels HTTP à l'API ComfyUI
+COMFYUI_HTTP_RETRIES = int(os.environ.get("COMFYUI_HTTP_RETRIES", "2"))
+COMFYUI_LOG_LINES = int(os.environ.get("COMFYUI_LOG_LINES", "1000"))  # Taille du ring buffer des logs ComfyUI
+COMFYUI_LOG_FORWARD = os.environ.get("COMFYUI_LOG_FORWARD", "0") == "1"  # Recopier les logs ComfyUI dans notre logger
+HEALTH_LOG_LINES = int(os.environ.get("HEALTH_LOG_LINES", "20"))
+IMAGE_TRANSPORT = os.environ.get("IMAGE_TRANSPORT", "auto")  # file | base64 | shm | auto (custom nodes chargés: shm en local, base64 si ComfyUI externe)
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", "500"))  # Nombre de jobs gardés pour les percentiles
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1") == "1"  # Refuser les jobs qui ne tiendraient pas leur deadline vu la file ComfyUI
+ADMISSION_WINDOW = int(os.environ.get("ADMISSION_WINDOW", "50"))  # Durées de prompt récentes gardées par (workflow, tier)
+ADMISSION_MIN_SAMPLES = int(os.environ.get("ADMISSION_MIN_SAMPLES", "5"))  # Pas d'estimation (donc pas de refus) en dessous
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "64"))  # Nombre max de paires par job batch
+STREAM_OUTPUT = os.environ.get("STREAM_OUTPUT", "0") == "1"  # Handler générateur: progression + images au fil de l'eau
+EAGER_BOOT = os.environ.get("EAGER_BOOT", "1") == "1"  # Démarrer ComfyUI et charger les modèles avant le premier job
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+WARMUP_IMAGE1 = os.environ.get("WARMUP_IMAGE1", "images/input.jpg")
+WARMUP_IMAGE2 = os.environ.get("WARMUP_IMAGE2", "images/target.jpg")
+WARMUP_TIMEOUT = int(os.environ.get("WARMUP_TIMEOUT", "900"))  # Chargement initial de Flux + CLIP + VAE + upscaler
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(NETWORK_STORAGE_PATH, "faceswap-cache", "results"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))  # 2 GiB partagés entre workers
+SOURCE_CACHE_ENABLED = os.environ.get("SOURCE_CACHE_ENABLED", "1") == "1"  # Précalcul par identité source (détection + crop du visage)
+SOURCE_CACHE_DIR = os.environ.get("SOURCE_CACHE_DIR", os.path.join(NETWORK_STORAGE_PATH, "faceswap-cache", "sources"))
+SOURCE_CACHE_MAX_BYTES = int(os.environ.get("SOURCE_CACHE_MAX_BYTES", str(512 * 1024 ** 2)))
+PREPROCESS_ENABLED = os.environ.get("PREPROCESS_ENABLED", "1") == "1"  # Normaliser les images clientes (EXIF, taille, ré-encodage) avant soumission
+PREPROCESS_MAX_SIDE = int(os.environ.get("PREPROCESS_MAX_SIDE", "0"))  # Côté max des entrées quand le workflow ne fixe pas leur résolution (0 = résolution d'origine)
+PREPROCESS_QUALITY = int(os.environ.get("PREPROCESS_QUALITY", "95"))  # Qualité JPEG des entrées ré-encodées
+PREPROCESS_CACHE_DIR = os.environ.get("PREPROCESS_CACHE_DIR", "/tmp/faceswap-inputs")  # Disque local: lu directement par ComfyUI
+PREPROCESS_CACHE_MAX_BYTES = int(os.environ.get("PREPROCESS_CACHE_MAX_BYTES", str(1024 ** 3)))
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "inline")  # inline (base64 dans la réponse) | reference (fichier + chemin/checksum)
+OUTPUT_STORE = os.environ.get("OUTPUT_STORE", "local")  # Backend du mode reference (voir OUTPUT_STORES)
+OUTPUT_STORE_DIR = os.environ.get("OUTPUT_STORE_DIR", os.path.join(NETWORK_STORAGE_PATH, "faceswap-outputs"))
+OUTPUT_ENCODE_WORKERS = int(os.environ.get("OUTPUT_ENCODE_WORKERS", str(min(4, os.cpu_count() or 1))))  # Ré-encodages de sortie en parallèle
+QUALITY_TIER = os.environ.get("QUALITY_TIER", "standard")  # Tier des requêtes sans "quality" (voir QUALITY_TIERS)
+SEQUENCE_MAX_FRAMES = int(os.environ.get("SEQUENCE_MAX_FRAMES", "3000"))  # Nombre max de frames d'une séquence
+SEQUENCE_TIMEOUT = int(os.environ.get("SEQUENCE_TIMEOUT", "3600"))  # Délai par défaut d'un job "sequence" (toute la vidéo), surchargeable via "timeout"
+SEQUENCE_WINDOW = int(os.environ.get("SEQUENCE_WINDOW", "4"))  # Frames soumises à ComfyUI en avance sur la collecte
+# Écart max par pixel (0-255, vignette 64x64) pour réutiliser une frame; 0 = doublons exacts.
+# Mesuré: ré-encodage JPEG/bruit léger d'une même image 2-7, déplacement de 0,5 % ou bouche modifiée >= 44
+SEQUENCE_DEDUP_THRESHOLD = int(os.environ.get("SEQUENCE_DEDUP_THRESHOLD", "6"))
+SEQUENCE_FPS = float(os.environ.get("SEQUENCE_FPS", "25"))  # Cadence des vidéos produites à partir d'images
+SEQUENCE_OUTPUT_DIR = os.environ.get("SEQUENCE_OUTPUT_DIR", os.path.join(OUTPUT_STORE_DIR, "sequences"))
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", "ffprobe")
+
+# Workflow injection points
+INPUT_TITLE_HINTS = {
+    "image1": ("new face", "source", "image1"),
+    "image2": ("target", "image2"),
+}
+OUTPUT_NODE_CLASSES = {"SaveImage"}
+FRAME_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")  # Frames d'un dossier ou d'une archive
+VIDEO_CODECS = {".mp4": "libx264", ".mov": "libx264", ".mkv": "libx264", ".webm": "libvpx-vp9"}  # Extension de sortie -> encodeur ffmpeg
+RESIZE_NODE_INPUTS = {"ImageScale": ("width", "height"), "ImageResize+": ("width", "height")}  # Nodes qui fixent la résolution d'une image
+SOURCE_ARTIFACT_CLASSES = {  # Nodes dont la sortie 0 est une IMAGE, réutilisables comme artefact d'une identité source
+    "ImageCropWithBBox(FaceParsing)", "ImageCrop", "ImageCrop+", "ImageScale", "ImageResize+", "EmptyImage",
+}
+BYPASS_NODE_INPUTS = {"ImageUpscaleWithModel": "image"}  # Nodes court-circuitables -> entrée reliée à leurs consommateurs
+QUALITY_TIERS = {  # "quality" d'une requête: params par défaut, côté max des entrées (prétraitement), nodes court-circuités
+    "preview": {"params": {"steps": 8}, "max_side": 768, "bypass": ("ImageUpscaleWithModel",)},
+    "standard": {"params": {}, "max_side": None, "bypass": ()},
+    "max": {"params": {"steps": 40}, "max_side": None, "bypass": ()},
+}
+
+# Custom nodes bundled in custom_nodes/faceswap_io (zero-disk image I/O)
+LOAD_IMAGE_BASE64_CLASS = "FaceSwapLoadImageBase64"
+LOAD_IMAGE_SHM_CLASS = "FaceSwapLoadImageSharedMemory"
+SEND_IMAGE_WS_CLASS = "FaceSwapSendImageWebSocket"
+FACESWAP_IMAGE_EVENT = 0x46530001  # Type des frames binaires WebSocket envoyées par SEND_IMAGE_WS_CLASS
+WORKFLOW_PARAM_SLOTS = {
+    "seed": ("KSampler", "seed"),
+    "steps": ("KSampler", "steps"),
+    "cfg": ("KSampler", "cfg"),
+    "denoise": ("KSampler", "denoise"),
+    "sampler_name": ("KSampler", "sampler_name"),
+    "scheduler": ("KSampler", "scheduler"),
+    "guidance": ("FluxGuidance", "guidance"),
+    "prompt_text": ("CLIPTextEncode", "text"),
+}
 
 # Global variables
-comfyui_process = None
+models_loaded = threading.Event()  # Set once an instance has run the warmup prompt or a job (all loader nodes resident)
+BOOT_TIMINGS: Dict[str, float] = {}
 
-def start_comfyui() -> bool:
-    """Start ComfyUI if not already running"""
-    global comfyui_process
-    try:
-        if comfyui_process is None:
-            # Vérifier que le chemin vers ComfyUI existe
-            comfyui_main_path = os.path.join(COMFYUI_PATH, "main.py")
-            if not os.path.exists(comfyui_main_path):
-                print(f"ERROR: ComfyUI main.py not found at {comfyui_main_path}", file=sys.stderr)
-                # Essayer de trouver main.py ailleurs
-                potential_paths = ["/root/ComfyUI/main.py", "/ComfyUI/main.py", "./ComfyUI/main.py"]
-                for path in potential_paths:
-                    if os.path.exists(path):
-                        comfyui_main_path = path
-                        print(f"Found ComfyUI main.py at {comfyui_main_path}", file=sys.stderr)
-                        break
-                else:
-                    print("CRITICAL ERROR: Could not find ComfyUI main.py anywhere!", file=sys.stderr)
-                    print(f"Current directory contents: {os.listdir('.')}", file=sys.stderr)
-                    print(f"Root directory contents: {os.listdir('/')}", file=sys.stderr)
-                    sys.stderr.flush()
+class ComfyLogDrain:
+    """Drains ComfyUI's stdout/stderr on background threads into a ring buffer.
+
+    Reading continuously keeps the OS pipe buffers from filling up (which
+    would block ComfyUI mid-inference), while the deque bounds memory to the
+    last `max_lines` lines. Lines can optionally be forwarded to our logger.
+    """
+
+    def __init__(self, max_lines: int = 1000, forward: bool = False, name: str = "comfyui"):
+        self.lines: "deque[str]" = deque(maxlen=max_lines)
+        self.forward = forward
+        self.name = name
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._logger = logging.getLogger(name)
+
+    def attach(self, process: subprocess.Popen) -> None:
+        """Start one reader thread per captured stream of `process`."""
+        self._threads = []
+        for name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+            if stream is None:
+                continue
+            thread = threading.Thread(target=self._drain, args=(name, stream),
+                                      name=f"{self.name}-{name}-drain", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _drain(self, name: str, stream) -> None:
+        try:
+            for raw in iter(stream.readline, b""):
+                line = raw.decode("utf-8", "replace").rstrip()
+                with self._lock:
+                    self.lines.append(f"[{name}] {line}")
+                if self.forward:
+                    self._logger.info(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            stream.close()
+
+    def join(self, timeout: float = 2.0) -> None:
+        """Wait for the reader threads to reach EOF (after the process exited)."""
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def tail(self, n: Optional[int] = None) -> List[str]:
+        with self._lock:
+            lines = list(self.lines)
+        return lines[-n:] if n else lines
+
+    def dump(self, n: Optional[int] = None) -> None:
+        """Print the last `n` lines to stderr for diagnostics."""
+        print("\n[ComfyUI LOG TAIL]:\n" + "\n".join(self.tail(n)), file=sys.stderr)
+        sys.stderr.flush()
+
+
+class ComfyExecutionError(Exception):
+    """Raised when ComfyUI reports an error or interruption for a prompt."""
+
+    def __init__(self, message: str, details: Optional[Dict[str, Any]] = None):
+        super().__init__(message)
+        self.details = details or {}
+
+
+class JobCancelled(Exception):
+    """Raised while waiting on a prompt whose job was cancelled by the caller."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a job's deadline (or a prompt's wait timeout) has passed.
+
+    Distinct from TimeoutError, which also covers socket timeouts of single
+    HTTP calls to ComfyUI: those are ordinary request failures.
+    """
+
+
+class ComfyHTTPError(Exception):
+    """Non-2xx response from the ComfyUI API."""
+
+    def __init__(self, code: int, reason: str, body: str):
+        super().__init__(f"HTTP Error {code}: {reason}")
+        self.code = code
+        self.reason = reason
+        self.body = body
+
+
+class ComfyClient:
+    """HTTP client for one ComfyUI instance over a pool of keep-alive connections.
+
+    Every API call (readiness polls, /prompt, /history, /view, /queue) reuses
+    an idle HTTPConnection instead of opening a new TCP connection. Timeouts
+    are uniform, and connection-level failures are retried on a fresh
+    connection; POSTs are only retried when a reused connection turned out
+    to be stale. `download_many` fetches several output images in parallel.
+    """
+
+    RETRYABLE_ERRORS = (ConnectionError, http.client.RemoteDisconnected, http.client.BadStatusLine, socket.timeout)
+
+    def __init__(self, host: str, timeout: float = 30.0, retries: int = 2, pool_size: int = 8):
+        self.host = host
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._idle: List[http.client.HTTPConnection] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _acquire(self) -> tuple:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return http.client.HTTPConnection(self.host, timeout=self.timeout), False
+
+    def _release(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                timeout: Optional[float] = None, retries: Optional[int] = None) -> bytes:
+        """Perform a request and return the response body.
+
+        Raises ComfyHTTPError for non-2xx statuses and OSError/HTTPException
+        once retries are exhausted.
+        """
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        attempts = (self.retries if retries is None else retries) + 1
+        attempt = 0
+        while True:
+            conn, reused = self._acquire()
+            conn.timeout = timeout or self.timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                stale = reused and isinstance(e, (ConnectionError, http.client.RemoteDisconnected))
+                if stale and method == "POST":
+                    continue  # Connexion keep-alive fermée par le serveur: rien n'a été traité
+                attempt += 1
+                if method == "POST" or attempt >= attempts or not isinstance(e, self.RETRYABLE_ERRORS):
+                    raise
+                time.sleep(min(0.05 * 2 ** attempt, 1.0))
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if not 200 <= response.status < 300:
+                raise ComfyHTTPError(response.status, response.reason, data.decode("utf-8", "replace"))
+            return data
+
+    def get_json(self, path: str, timeout: Optional[float] = None, retries: Optional[int] = None) -> Any:
+        return json.loads(self.request("GET", path, timeout=timeout, retries=retries))
+
+    def post_json(self, path: str, payload: Any, timeout: Optional[float] = None) -> Any:
+        data = self.request("POST", path, body=json.dumps(payload).encode("utf-8"), timeout=timeout)
+        return json.loads(data) if data else None
+
+    def view(self, image: Dict[str, Any]) -> bytes:
+        """Download one output image described by a history/executed entry."""
+        params = urllib.parse.urlencode({
+            "filename": image['filename'],
+            "subfolder": image['subfolder'],
+            "type": image['type']
+        })
+        return self.request("GET", f"/view?{params}")
+
+    def download_many(self, images: List[Dict[str, Any]]) -> List[bytes]:
+        """Download several output images concurrently, preserving order."""
+        if len(images) <= 1:
+            return [self.view(image) for image in images]
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="comfyui-download")
+        return list(self._executor.map(self.view, images))
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class ComfyEventStream:
+    """One long-lived WebSocket per ComfyUI instance, demultiplexed by prompt_id.
+
+    A background reader thread receives every frame and forwards prompt events
+    (executing, progress, executed, execution_*) to the queue registered for
+    their prompt_id. Events that arrive before a waiter registers are buffered.
+    The connection is re-opened with backoff when it drops, and pending prompts
+    are re-synchronised from /history since events sent meanwhile are lost.
+    """
+
+    PROMPT_EVENTS = {
+        "execution_start", "execution_cached", "executing", "progress", "executed",
+        "execution_success", "execution_error", "execution_interrupted", "faceswap_image",
+    }
+
+    def __init__(self, host: str, client: ComfyClient, client_id: Optional[str] = None, orphan_limit: int = 256):
+        self.host = host
+        self.client = client
+        self.client_id = client_id or str(uuid.uuid4())
+        self.connected = threading.Event()
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+        self.queue_remaining: Optional[int] = None
+        self._orphan_limit = orphan_limit
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, "queue.Queue[Dict[str, Any]]"] = {}
+        self._orphans: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._ws = None
+
+    def start(self) -> None:
+        """Start the reader thread (idempotent)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"comfyui-ws-reader-{self.host}", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def register(self, prompt_id: str) -> "queue.Queue[Dict[str, Any]]":
+        """Return the event queue for prompt_id, replaying any buffered events."""
+        events: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        with self._lock:
+            self._waiters[prompt_id] = events
+            for message in self._orphans.pop(prompt_id, []):
+                events.put(message)
+        return events
+
+    def unregister(self, prompt_id: str) -> None:
+        with self._lock:
+            self._waiters.pop(prompt_id, None)
+            self._orphans.pop(prompt_id, None)
+
+    def pending(self) -> int:
+        """Number of prompts currently waited on through this stream."""
+        with self._lock:
+            return len(self._waiters)
+
+    def fail_pending(self, reason: str) -> None:
+        """Fail every registered waiter at once (the ComfyUI process behind it is gone)."""
+        with self._lock:
+            waiters, self._waiters = self._waiters, {}
+        for prompt_id, events in waiters.items():
+            events.put({"type": "execution_error", "data": {"prompt_id": prompt_id, "exception_message": reason}})
+
+    def _dispatch(self, message: Dict[str, Any]) -> None:
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if msg_type == "status":
+            exec_info = (data.get("status") or {}).get("exec_info") or {}
+            self.queue_remaining = exec_info.get("queue_remaining", self.queue_remaining)
+            return
+        prompt_id = data.get("prompt_id")
+        if msg_type not in self.PROMPT_EVENTS or prompt_id is None:
+            return
+        with self._lock:
+            events = self._waiters.get(prompt_id)
+            if events is None:
+                self._orphans.setdefault(prompt_id, []).append(message)
+                self._orphans.move_to_end(prompt_id)
+                while len(self._orphans) > self._orphan_limit:
+                    self._orphans.popitem(last=False)
+                return
+        events.put(message)
+
+    def _dispatch_binary(self, frame: bytes) -> None:
+        """Route result images sent by the faceswap_io WebSocket output node.
+
+        Other binary frames (e.g. sampler previews) are ignored.
+        """
+        if len(frame) < 8 or struct.unpack(">I", frame[:4])[0] != FACESWAP_IMAGE_EVENT:
+            return
+        header_len = struct.unpack(">I", frame[4:8])[0]
+        data = json.loads(frame[8:8 + header_len])
+        data["image"] = bytes(frame[8 + header_len:])
+        self._dispatch({"type": "faceswap_image", "data": data})
+
+    def _resync(self) -> None:
+        """After a reconnect, complete waiters whose prompt finished while we were away."""
+        with self._lock:
+            pending = list(self._waiters)
+        for prompt_id in pending:
+            try:
+                history = self.client.get_json(f"/history/{prompt_id}", timeout=10)
+            except Exception as e:
+                logger.warning(f"History resync failed for {prompt_id}: {e}")
+                continue
+            entry = history.get(prompt_id)
+            if not entry:
+                continue
+            status = entry.get("status") or {}
+            if status.get("status_str") == "error":
+                self._dispatch({"type": "execution_error",
+                                "data": {"prompt_id": prompt_id, "exception_message": "Execution failed (resynced from history)"}})
+            elif status.get("completed", True):
+                self._dispatch({"type": "execution_success", "data": {"prompt_id": prompt_id, "resynced": True}})
+
+    def _run(self) -> None:
+        delay = 0.1
+        while not self._stop.is_set():
+            try:
+                ws = websocket.WebSocket()
+                ws.connect(f"ws://{self.host}/ws?clientId={self.client_id}", timeout=10)
+                ws.settimeout(30)
+                self._ws = ws
+                self.connected.set()
+                if self.reconnects:
+                    logger.info(f"ComfyUI WebSocket reconnected (#{self.reconnects})")
+                    self._resync()
+                delay = 0.1
+                while not self._stop.is_set():
+                    try:
+                        out = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        ws.ping()
+                        continue
+                    if isinstance(out, str):
+                        self._dispatch(json.loads(out))
+                    elif out:
+                        self._dispatch_binary(out)
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                self.last_error = str(e)
+                logger.warning(f"ComfyUI WebSocket error: {e}; reconnecting in {delay:.1f}s")
+            finally:
+                self.connected.clear()
+                if self._ws is not None:
+                    try:
+                        self._ws.close()
+                    except Exception:
+                        pass
+                    self._ws = None
+            self.reconnects += 1
+            self._stop.wait(delay)
+            delay = min(delay * 2, 5.0)
+
+
+def iter_prompt_events(events: "queue.Queue[Dict[str, Any]]", prompt_id: str, timeout: float,
+                       cancelled: Optional[threading.Event] = None):
+    """Yield prompt_id's events until it has finished executing.
+
+    Raises DeadlineExceeded if nothing completes within `timeout` seconds,
+    JobCancelled once `cancelled` is set and ComfyExecutionError if ComfyUI
+    reports an error or an interruption.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if cancelled is not None and cancelled.is_set():
+            raise JobCancelled(f"Prompt {prompt_id} cancelled")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Prompt {prompt_id} did not finish within {timeout:.0f} seconds")
+        try:
+            # Réveil périodique pour voir une annulation sans attendre le prochain event
+            message = events.get(timeout=min(remaining, 0.25) if cancelled is not None else remaining)
+        except queue.Empty:
+            continue
+        msg_type = message["type"]
+        data = message["data"]
+        if msg_type == "execution_success" or (msg_type == "executing" and data.get("node") is None):
+            return
+        if msg_type == "execution_error" and data.get("node_id") is None:
+            raise ComfyExecutionError(f"ComfyUI execution error: {data.get('exception_message')}", data)
+        if msg_type == "execution_error":
+            raise ComfyExecutionError(
+                f"ComfyUI execution error in node {data.get('node_id')} ({data.get('node_type')}): "
+                f"{data.get('exception_message')}", data)
+        if msg_type == "execution_interrupted":
+            raise ComfyExecutionError("ComfyUI execution interrupted", data)
+        yield message
+
+
+def wait_for_prompt(events: "queue.Queue[Dict[str, Any]]", prompt_id: str, timeout: float) -> None:
+    """Block until prompt_id has finished executing (see iter_prompt_events)."""
+    for _ in iter_prompt_events(events, prompt_id, timeout):
+        pass
+
+
+class ComfyInstance:
+    """One ComfyUI server: its process (unless external), HTTP client, WebSocket and logs.
+
+    A spawned instance listens on its own port and is pinned to one device:
+    a CUDA index (through CUDA_VISIBLE_DEVICES) or, for "cpu", an optional
+    set of cores so several CPU instances don't fight over the same ones.
+    """
+
+    def __init__(self, index: int, host: str, device: str = "cpu", cores: Optional[List[int]] = None,
+                 external: bool = False):
+        self.index = index
+        self.name = f"comfyui-{index}"
+        self.host = host
+        self.device = device
+        self.cores = cores
+        self.external = external
+        self.process: Optional[subprocess.Popen] = None
+        self.output_dirs: Dict[str, str] = {}  # Type d'image ComfyUI ("output", "temp") -> dossier local
+        self.client = ComfyClient(host, COMFYUI_HTTP_TIMEOUT, COMFYUI_HTTP_RETRIES, pool_size=MAX_CONCURRENCY * 2 + 2)
+        self.events = ComfyEventStream(host, self.client)
+        self.logs = ComfyLogDrain(COMFYUI_LOG_LINES, COMFYUI_LOG_FORWARD, name=self.name)
+        self.ready = threading.Event()  # API up and WebSocket subscribed: prompts can be routed here
+        self.warm = threading.Event()  # Models resident (warmup or a real job ran)
+        self.restarts = 0
+        self.restarting = False  # Redémarrage (et warmup) en cours par le superviseur
+        self.starting = False  # start() en cours (job ou superviseur): le process peut ne pas encore répondre
+        self.start_failures = 0  # Échecs de démarrage consécutifs, pour le backoff
+        self.last_start_attempt: Optional[float] = None  # Horloge monotone; None = jamais tenté
+        self.last_error: Optional[str] = None
+        self.unresponsive_since: Optional[float] = None
+        self.health: Dict[str, Any] = {"checked_at": None, "api_accessible": False}
+        self.last_workflow: Optional[str] = None
+        self.recent_sources: "deque[str]" = deque(maxlen=8)
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return int(self.host.rsplit(":", 1)[1])
+
+    def alive(self) -> bool:
+        return self.external or (self.process is not None and self.process.poll() is None)
+
+    def load(self) -> int:
+        """Prompts queued or running on this instance.
+
+        Our own in-flight prompts are counted as soon as they are routed; the
+        queue_remaining pushed by ComfyUI's status events also covers prompts
+        submitted by other clients.
+        """
+        return max(self.events.pending(), self.events.queue_remaining or 0)
+
+    def start(self) -> bool:
+        """Start (or wait for) this instance and subscribe to its WebSocket.
+
+        A process that died since the last start is reaped and replaced.
+        """
+        with self._lock:
+            if self.ready.is_set() and self.alive():
+                return True
+            self.starting = True
+            try:
+                if self.process is not None and self.process.poll() is not None:
+                    self._reap_locked()
+                if not self._start_locked():
+                    self.start_failures += 1
+                    self.last_error = f"Start attempt {self.start_failures} failed"
+                    self.starting = False
                     return False
-            
-            print(f"Starting ComfyUI from {comfyui_main_path}...", file=sys.stderr)
-            sys.stderr.flush()
-            
-            # Lancer ComfyUI avec uniquement les options reconnues
-            comfyui_process = subprocess.Popen(
-                [
-                    "python", comfyui_main_path,
-                    "--listen", "--port", "8188",
-                    "--cpu"
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env={**os.environ, "COMFYUI_NO_DOWNLOAD": "1", "COMFYUI_SKIP_AUTODOWNLOAD": "1"}
-            )
-            
-            ready = False
-            start_time = time.time()
-            while not ready and time.time() - start_time < COMFYUI_TIMEOUT:
+                self.start_failures = 0
+            except BaseException:
+                self.starting = False
+                raise
+        try:
+            self.events.start()
+            # Ne pas soumettre de prompt avant que le WebSocket soit abonné
+            if not self.events.connected.wait(timeout=10):
+                print(f"WARNING: {self.name} WebSocket not connected yet", file=sys.stderr)
+                sys.stderr.flush()
+            self.ready.set()
+        finally:
+            self.starting = False
+        self.probe()
+        return True
+
+    def restart(self) -> bool:
+        """Replace a crashed or killed process; prompts that were running on it fail right away."""
+        with self._lock:
+            if self.ready.is_set() and self.alive():
+                return True  # Relancée entre-temps par le start() d'un job: rien à remplacer
+            self._reap_locked()
+        return self.start()
+
+    def _reap_locked(self) -> None:
+        self.ready.clear()
+        self.warm.clear()
+        if self.process is not None:
+            if self.process.poll() is None:
+                # Jamais de process orphelin: il garderait le port de l'instance
+                self.process.terminate()
                 try:
-                    with urllib.request.urlopen(f"http://{COMFYUI_HOST}/system_stats") as response:
-                        if response.status == 200:
-                            print("ComfyUI started and ready!", file=sys.stderr)
-                            sys.stderr.flush()
-                            ready = True
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait(timeout=10)
+            self.logs.join()
+            print(f"\n[ERROR] {self.name} terminated with code {self.process.returncode}, restarting", file=sys.stderr)
+            self.logs.dump(200)
+            self.process = None
+            self.restarts += 1
+        self.unresponsive_since = None
+        self.events.fail_pending(f"ComfyUI instance {self.name} stopped while the prompt was queued or running")
+
+    def start_due(self) -> bool:
+        """A start may be attempted: never tried yet, or the restart backoff has elapsed."""
+        return (self.last_start_attempt is None
+                or time.monotonic() - self.last_start_attempt >= self.restart_delay())
+
+    def restart_delay(self) -> float:
+        """Minimum time between start attempts: COMFYUI_RESTART_DELAY doubled per consecutive failure."""
+        return min(COMFYUI_RESTART_DELAY * 2 ** self.start_failures, COMFYUI_RESTART_MAX_DELAY)
+
+    def probe(self) -> Dict[str, Any]:
+        """Query /system_stats once and replace the cached health snapshot.
+
+        The snapshot (API liveness and latency, RAM/VRAM per device, last
+        error) is what health_check() reports, so it never waits on ComfyUI.
+        """
+        snapshot: Dict[str, Any] = {"checked_at": time.time(), "api_accessible": False}
+        start = time.perf_counter()
+        try:
+            stats = json.loads(self.client.request("GET", "/system_stats", timeout=COMFYUI_PROBE_TIMEOUT, retries=0))
+            system = stats.get("system", {})
+            snapshot.update({
+                "api_accessible": True,
+                "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+                "ram_total": system.get("ram_total"),
+                "ram_free": system.get("ram_free"),
+                "devices": [{key: device.get(key) for key in ("name", "type", "vram_total", "vram_free")}
+                            for device in stats.get("devices", [])],
+            })
+            self.unresponsive_since = None
+        except Exception as e:
+            self.last_error = f"Health probe failed: {str(e)}"
+            if self.unresponsive_since is None:
+                self.unresponsive_since = time.monotonic()
+        self.health = snapshot
+        return snapshot
+
+    def hung(self) -> bool:
+        """Process alive but its API has not answered a probe for COMFYUI_HUNG_TIMEOUT seconds."""
+        return (not self.external and COMFYUI_HUNG_TIMEOUT > 0 and self.unresponsive_since is not None
+                and time.monotonic() - self.unresponsive_since > COMFYUI_HUNG_TIMEOUT)
+
+    def kill(self, reason: str) -> None:
+        """Kill a hung process; the supervisor then restarts it like a crashed one."""
+        self.last_error = reason
+        print(f"[ERROR] Killing {self.name}: {reason}", file=sys.stderr)
+        sys.stderr.flush()
+        process = self.process
+        if process is not None:
+            process.kill()
+            process.wait(timeout=10)
+
+    def _command(self, main_path: str) -> tuple:
+        command = ["python", main_path, "--listen", "--port", str(self.port)]
+        env = {**os.environ, "COMFYUI_NO_DOWNLOAD": "1", "COMFYUI_SKIP_AUTODOWNLOAD": "1"}
+        if self.device == "cpu":
+            command.append("--cpu")
+            if self.cores:
+                env["OMP_NUM_THREADS"] = str(len(self.cores))
+        else:
+            env["CUDA_VISIBLE_DEVICES"] = self.device
+        comfyui_dir = os.path.dirname(main_path)
+        self.output_dirs = {"output": os.path.join(comfyui_dir, "output"), "temp": os.path.join(comfyui_dir, "temp")}
+        if COMFYUI_INSTANCES > 1:
+            # Compteurs de fichiers de SaveImage propres à chaque process
+            self.output_dirs = {kind: os.path.join(path, self.name) for kind, path in self.output_dirs.items()}
+            command += ["--output-directory", self.output_dirs["output"], "--temp-directory", self.output_dirs["temp"]]
+        return command, env
+
+    def remove_outputs(self, outputs: Dict[str, Any]) -> int:
+        """Delete the image files listed in a history entry's outputs; returns how many.
+
+        Only possible for spawned instances, whose directories are local.
+        """
+        removed = 0
+        for node_output in outputs.values():
+            for image in node_output.get("images", []):
+                root = self.output_dirs.get(image.get("type"))
+                if not root:
+                    continue
+                path = os.path.normpath(os.path.join(root, image.get("subfolder", ""), image.get("filename", "")))
+                if not path.startswith(os.path.normpath(root) + os.sep):
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def _wait_external(self) -> bool:
+        """External instance: ComfyUI is managed elsewhere, only wait for its API."""
+        start_time = time.time()
+        poll_delay = 0.05
+        while time.time() - start_time < COMFYUI_TIMEOUT:
+            try:
+                self.client.request("GET", "/system_stats", timeout=2, retries=0)
+                return True
+            except Exception:
+                time.sleep(poll_delay)
+                poll_delay = min(poll_delay * 1.5, 1.0)
+        print(f"Timeout waiting for external ComfyUI at {self.host} after {COMFYUI_TIMEOUT} seconds", file=sys.stderr)
+        sys.stderr.flush()
+        return False
+
+    def _start_locked(self) -> bool:
+        self.last_start_attempt = time.monotonic()
+        if self.external:
+            return self._wait_external()
+        try:
+            if self.process is None:
+                # Vérifier que le chemin vers ComfyUI existe
+                comfyui_main_path = os.path.join(COMFYUI_PATH, "main.py")
+                if not os.path.exists(comfyui_main_path):
+                    print(f"ERROR: ComfyUI main.py not found at {comfyui_main_path}", file=sys.stderr)
+                    # Essayer de trouver main.py ailleurs
+                    potential_paths = ["/root/ComfyUI/main.py", "/ComfyUI/main.py", "./ComfyUI/main.py"]
+                    for path in potential_paths:
+                        if os.path.exists(path):
+                            comfyui_main_path = path
+                            print(f"Found ComfyUI main.py at {comfyui_main_path}", file=sys.stderr)
                             break
-                except Exception as e:
-                    # Vérifier si le processus est toujours en cours
-                    if comfyui_process.poll() is not None:
-                        # Le processus s'est arrêté, récupérer la sortie
-                        stdout, stderr = comfyui_process.communicate()
-                        print(f"\n[ERROR] ComfyUI process terminated with code {comfyui_process.returncode}", file=sys.stderr)
-                        print(f"\n[ComfyUI STDOUT]:\n{stdout.decode()}", file=sys.stderr)
-                        print(f"\n[ComfyUI STDERR]:\n{stderr.decode()}", file=sys.stderr)
+                    else:
+                        print("CRITICAL ERROR: Could not find ComfyUI main.py anywhere!", file=sys.stderr)
+                        print(f"Current directory contents: {os.listdir('.')}", file=sys.stderr)
+                        print(f"Root directory contents: {os.listdir('/')}", file=sys.stderr)
                         sys.stderr.flush()
                         return False
-                    
-                    # Afficher un point pour montrer que ça travaille
-                    if int(time.time() - start_time) % 5 == 0:
-                        print(".", end="", file=sys.stderr)
+
+                print(f"Starting {self.name} from {comfyui_main_path} on port {self.port} (device {self.device})...", file=sys.stderr)
+                sys.stderr.flush()
+
+                # Lancer ComfyUI avec uniquement les options reconnues
+                command, env = self._command(comfyui_main_path)
+                self.process = subprocess.Popen(
+                    command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=env
+                )
+                if self.cores:
+                    # Pas de preexec_fn (risque de deadlock après fork d'un process multithreadé):
+                    # l'affinité est posée juste après, avant que ComfyUI ne crée ses threads
+                    try:
+                        os.sched_setaffinity(self.process.pid, self.cores)
+                    except OSError as e:
+                        print(f"WARNING: could not pin {self.name} to cores {self.cores}: {str(e)}", file=sys.stderr)
                         sys.stderr.flush()
-                    
-                    time.sleep(1)
-            
-            if not ready:
-                # Timeout atteint, afficher les logs ComfyUI pour diagnostic
-                if comfyui_process is not None:
+                # Vider stdout/stderr en continu, sinon ComfyUI bloque quand le pipe est plein
+                self.logs.attach(self.process)
+
+                ready = False
+                start_time = time.time()
+                poll_delay = 0.05  # Backoff fin: 50ms -> 1s, pour détecter la disponibilité au plus tôt
+                last_dot = start_time
+                while not ready and time.time() - start_time < COMFYUI_TIMEOUT:
                     try:
-                        comfyui_process.terminate()  # Terminer proprement
-                        stdout, stderr = comfyui_process.communicate(timeout=5)
-                        print(f"\n[ComfyUI STDOUT]:\n{stdout.decode()}", file=sys.stderr)
-                        print(f"\n[ComfyUI STDERR]:\n{stderr.decode()}", file=sys.stderr)
+                        self.client.request("GET", "/system_stats", timeout=2, retries=0)
+                        print(f"{self.name} started and ready!", file=sys.stderr)
                         sys.stderr.flush()
+                        ready = True
+                        break
+                    except Exception as e:
+                        # Vérifier si le processus est toujours en cours
+                        if self.process.poll() is not None:
+                            # Le processus s'est arrêté, afficher la fin de ses logs
+                            self.logs.join()
+                            print(f"\n[ERROR] {self.name} process terminated with code {self.process.returncode}", file=sys.stderr)
+                            self.logs.dump(200)
+                            self.process = None
+                            return False
+
+                        # Afficher un point pour montrer que ça travaille
+                        if time.time() - last_dot >= 5:
+                            last_dot = time.time()
+                            print(".", end="", file=sys.stderr)
+                            sys.stderr.flush()
+
+                        time.sleep(poll_delay)
+                        poll_delay = min(poll_delay * 1.5, 1.0)
+
+                if not ready:
+                    # Timeout atteint, afficher les logs ComfyUI pour diagnostic
+                    try:
+                        self.process.terminate()  # Terminer proprement
+                        self.process.wait(timeout=5)
+                        self.logs.join()
+                        self.logs.dump(200)
                     except Exception as e:
                         print(f"Error getting ComfyUI output: {str(e)}", file=sys.stderr)
                         sys.stderr.flush()
-                
-                print(f"Timeout starting ComfyUI after {COMFYUI_TIMEOUT} seconds", file=sys.stderr)
-                sys.stderr.flush()
+                    self.process = None
+
+                    print(f"Timeout starting {self.name} after {COMFYUI_TIMEOUT} seconds", file=sys.stderr)
+                    sys.stderr.flush()
+                    return False
+
+                return ready
+            return True
+        except Exception as e:
+            print(f"Error starting {self.name}: {str(e)}", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+            sys.stderr.flush()
+            return False
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "host": self.host,
+            "device": self.device,
+            "cores": self.cores,
+            "running": self.alive(),
+            "ready": self.ready.is_set(),
+            "models_loaded": self.warm.is_set(),
+            "in_flight": self.events.pending(),
+            "queue_remaining": self.events.queue_remaining,
+            "ws_connected": self.events.connected.is_set(),
+            "ws_reconnects": self.events.reconnects,
+            "restarts": self.restarts,
+            "restarting": self.restarting,
+            "start_failures": self.start_failures,
+            "last_error": self.last_error,
+            "health": self.health,
+            "last_workflow": self.last_workflow,
+            "log_tail": self.logs.tail(HEALTH_LOG_LINES),
+        }
+
+
+class ComfyPool:
+    """Routes prompts across the ComfyUI instances of this worker.
+
+    Each prompt goes to the least-loaded ready instance. An instance that
+    last ran the same source image (or, to a lesser extent, the same
+    workflow) gets a bonus of up to COMFYUI_AFFINITY_SLACK prompts, so its
+    node-output and model caches are reused unless it is clearly busier.
+    A supervisor thread probes every instance on an interval (cached health
+    snapshot), restarts crashed or hung processes with backoff and warms
+    them up again before they take traffic; prompts on the other instances
+    are unaffected, and new prompts are held while no instance is ready.
+    """
+
+    def __init__(self, instances: List[ComfyInstance], affinity_slack: float = 1.0):
+        self.instances = instances
+        self.affinity_slack = affinity_slack
+        self._lock = threading.Lock()
+        self._supervisor_thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        """Start the instances; returns once at least one can take prompts.
+
+        Instances are started in parallel. When some are already ready, the
+        others are left to the supervisor so jobs are not held up. Instances
+        still in their restart backoff are not retried here; while the
+        supervisor restarts one, the call waits up to COMFYUI_RESTART_HOLD.
+        """
+        if not self.ready_instances():
+            due = [instance for instance in self.instances if not instance.restarting and instance.start_due()]
+            threads = [threading.Thread(target=instance.start, name=f"{instance.name}-start", daemon=True)
+                       for instance in due]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self._start_supervisor()
+        return bool(self.ready_instances()) or self.wait_ready(COMFYUI_RESTART_HOLD)
+
+    def ready_instances(self) -> List[ComfyInstance]:
+        return [instance for instance in self.instances if instance.ready.is_set() and instance.alive()]
+
+    def recovering(self) -> bool:
+        """Some instance is down or restarting, so the supervisor may bring one back soon."""
+        return any(instance.restarting or not instance.alive() for instance in self.instances)
+
+    def wait_ready(self, timeout: float) -> bool:
+        """Hold the caller until an instance is ready, as long as one is being recovered."""
+        deadline = time.monotonic() + timeout
+        while not self.ready_instances():
+            if not self.recovering() or time.monotonic() >= deadline:
                 return False
-            
-            return ready
+            time.sleep(0.25)
         return True
+
+    def acquire(self, prompt_id: str, affinity: Optional[tuple] = None) -> tuple:
+        """Pick an instance for prompt_id and register its waiter there: (instance, events).
+
+        `affinity` is (workflow_name, source_key). Choosing and registering
+        happen under one lock so concurrent jobs see each other's load.
+        """
+        workflow_name, source = affinity or (None, None)
+        # Instance(s) en cours de redémarrage: patienter plutôt qu'échouer
+        self.wait_ready(COMFYUI_RESTART_HOLD)
+        with self._lock:
+            candidates = self.ready_instances()
+            if not candidates:
+                raise RuntimeError("No ComfyUI instance is available")
+            # Une instance redémarrée recharge ses modèles: ne l'utiliser que faute de mieux
+            candidates = [instance for instance in candidates if not instance.restarting] or candidates
+
+            def score(instance: ComfyInstance) -> tuple:
+                bonus = 0.0
+                if source is not None and source in instance.recent_sources:
+                    bonus += self.affinity_slack
+                if workflow_name is not None and instance.last_workflow == workflow_name:
+                    bonus += self.affinity_slack / 2
+                load = instance.load()
+                return load - bonus, load, instance.index
+
+            instance = min(candidates, key=score)
+            events = instance.events.register(prompt_id)
+            if workflow_name is not None:
+                instance.last_workflow = workflow_name
+            if source is not None and source not in instance.recent_sources:
+                instance.recent_sources.append(source)
+        return instance, events
+
+    def any_ready(self) -> ComfyInstance:
+        ready = self.ready_instances()
+        return ready[0] if ready else self.instances[0]
+
+    def supervisor_running(self) -> bool:
+        return self._supervisor_thread is not None and self._supervisor_thread.is_alive()
+
+    def _start_supervisor(self) -> None:
+        with self._lock:
+            if self.supervisor_running():
+                return
+            self._supervisor_thread = threading.Thread(target=self._supervise, name="comfyui-supervisor", daemon=True)
+            self._supervisor_thread.start()
+
+    def _supervise(self) -> None:
+        while True:
+            time.sleep(COMFYUI_MONITOR_INTERVAL)
+            for instance in self.instances:
+                if instance.restarting:
+                    continue
+                try:
+                    self._check(instance)
+                except Exception as e:
+                    logger.warning(f"Supervisor check of {instance.name} failed: {e}")
+
+    def _check(self, instance: ComfyInstance) -> None:
+        instance.probe()
+        if instance.external or instance.starting:
+            return
+        if instance.ready.is_set() and instance.alive():
+            if not instance.hung():
+                return
+            instance.kill(f"API unresponsive for more than {COMFYUI_HUNG_TIMEOUT:.0f} seconds")
+        if not instance.start_due():
+            return
+        instance.restarting = True
+        threading.Thread(target=self._restart, args=(instance,), name=f"{instance.name}-restart", daemon=True).start()
+
+    @staticmethod
+    def _restart(instance: ComfyInstance) -> None:
+        try:
+            # Recharger les modèles avant de lui renvoyer du trafic
+            if instance.restart() and WARMUP_ENABLED:
+                _warmup_instance(instance)
+        except Exception as e:
+            instance.last_error = f"Restart failed: {str(e)}"
+            logger.warning(f"Restart of {instance.name} failed: {e}")
+        finally:
+            instance.restarting = False
+
+
+def _build_pool() -> ComfyPool:
+    """Instances from the environment: COMFYUI_HOST list when external, else COMFYUI_INSTANCES processes."""
+    if COMFYUI_EXTERNAL:
+        hosts = [host.strip() for host in COMFYUI_HOST.split(",") if host.strip()]
+        return ComfyPool([ComfyInstance(index, host, external=True) for index, host in enumerate(hosts)],
+                         COMFYUI_AFFINITY_SLACK)
+    devices = [device.strip() for device in COMFYUI_DEVICES.split(",") if device.strip()] or ["cpu"]
+    assigned = [devices[index % len(devices)] for index in range(max(1, COMFYUI_INSTANCES))]
+    # Plusieurs instances CPU: découper les cœurs disponibles en blocs contigus
+    cpu_slots = [index for index, device in enumerate(assigned) if device == "cpu"]
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    per_instance = len(cores) // len(cpu_slots) if cpu_slots else 0
+    instances = []
+    for index, device in enumerate(assigned):
+        core_set = None
+        if device == "cpu" and len(cpu_slots) > 1 and per_instance:
+            slot = cpu_slots.index(index)
+            core_set = cores[slot * per_instance:(slot + 1) * per_instance]
+        instances.append(ComfyInstance(index, f"127.0.0.1:{COMFYUI_BASE_PORT + index}", device, core_set))
+    return ComfyPool(instances, COMFYUI_AFFINITY_SLACK)
+
+
+comfy_pool = _build_pool()
+
+def start_comfyui() -> bool:
+    """Start the ComfyUI instances if needed; True once at least one accepts prompts."""
+    return comfy_pool.start()
+
+
+def submit_prompt(workflow: Dict[str, Any], affinity: Optional[tuple] = None,
+                  instance: Optional[ComfyInstance] = None) -> tuple:
+    """Queue `workflow` on ComfyUI and return (instance, prompt_id, events).
+
+    The instance is chosen by comfy_pool (see ComfyPool.acquire) unless one
+    is given. The waiter is registered on its WebSocket before the POST so
+    no event can be missed; the caller must unregister prompt_id when done.
+    Errors (including ComfyHTTPError) propagate to the caller.
+    """
+    # Le client_id est celui du WebSocket de l'instance: ComfyUI n'envoie les events qu'à lui.
+    # Le prompt_id est généré ici pour pouvoir s'abonner avant l'envoi (pas d'event perdu).
+    prompt_id = str(uuid.uuid4())
+    if instance is None:
+        instance, events = comfy_pool.acquire(prompt_id, affinity)
+    else:
+        events = instance.events.register(prompt_id)
+    try:
+        prompt = {"prompt": workflow, "client_id": instance.events.client_id, "prompt_id": prompt_id}
+        data = json.dumps(prompt).encode('utf-8')
+
+        # Debug: afficher le prompt envoyé (format condensé pour éviter trop de logs)
+        print(f"Sending prompt to ComfyUI: {data[:200].decode('utf-8', 'replace')}... (truncated)", file=sys.stderr)
+        sys.stderr.flush()
+
+        resp_json = json.loads(instance.client.request("POST", "/prompt", body=data))
+    except Exception:
+        instance.events.unregister(prompt_id)
+        raise
+    if resp_json['prompt_id'] != prompt_id:
+        # Ancienne version de ComfyUI qui ignore le prompt_id fourni
+        instance.events.unregister(prompt_id)
+        prompt_id = resp_json['prompt_id']
+        events = instance.events.register(prompt_id)
+    return instance, prompt_id, events
+
+def queue_position(instance: ComfyInstance, prompt_id: str) -> Optional[int]:
+    """Position of prompt_id in its instance's queue (0 = running or next), None if unknown."""
+    try:
+        queue_state = instance.client.get_json("/queue", timeout=5)
+    except Exception:
+        return None
+    if any(item[1] == prompt_id for item in queue_state.get("queue_running", [])):
+        return 0
+    pending = sorted(queue_state.get("queue_pending", []), key=lambda item: item[0])
+    for position, item in enumerate(pending):
+        if item[1] == prompt_id:
+            return position + len(queue_state.get("queue_running", []))
+    return None
+
+def cancel_prompt(instance: ComfyInstance, prompt_id: str) -> Dict[str, Any]:
+    """Stop a prompt whose result nobody will read and reclaim what it holds.
+
+    Removes it from the pending queue, interrupts it if it is already running,
+    then deletes its output files and history entry. Returns a cleanup report.
+    """
+    report = {"prompt_id": prompt_id, "instance": instance.name, "dequeued": False,
+              "interrupted": False, "files_removed": 0, "history_deleted": False}
+    try:
+        # Un prompt en attente peut démarrer entre deux appels: la file est relue après la suppression
+        queue_state = instance.client.get_json("/queue", timeout=5)
+        if any(item[1] == prompt_id for item in queue_state.get("queue_pending", [])):
+            instance.client.post_json("/queue", {"delete": [prompt_id]}, timeout=5)
+            report["dequeued"] = True
+            queue_state = instance.client.get_json("/queue", timeout=5)
+        if any(item[1] == prompt_id for item in queue_state.get("queue_running", [])):
+            # Interruption ciblée: ComfyUI ignore la requête si un autre prompt a pris la place
+            instance.client.post_json("/interrupt", {"prompt_id": prompt_id}, timeout=5)
+            report["interrupted"] = True
+        entry = instance.client.get_json(f"/history/{prompt_id}", timeout=5).get(prompt_id)
+        if entry:
+            report["files_removed"] = instance.remove_outputs(entry.get("outputs") or {})
+            instance.client.post_json("/history", {"delete": [prompt_id]}, timeout=5)
+            report["history_deleted"] = True
     except Exception as e:
-        print(f"Error starting ComfyUI: {str(e)}", file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        report["error"] = str(e)
+    print(f"Cancelled prompt {prompt_id} on {instance.name}: {report}", file=sys.stderr)
+    sys.stderr.flush()
+    return report
+
+def fetch_images(client: ComfyClient, images: List[Dict[str, Any]], trace: "JobTrace") -> List[tuple]:
+    """Download output images via /view (concurrently) as [(data, format)]."""
+    with trace.stage("fetch"):
+        downloaded = client.download_many(images)
+    # SaveImage n'écrit que du PNG
+    return [(img_bytes, "png") for img_bytes in downloaded]
+
+def progress_event(message: Dict[str, Any], workflow: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Translate a ComfyUI WebSocket event into a compact client progress event."""
+    msg_type = message["type"]
+    data = message["data"]
+    if msg_type == "execution_start":
+        return {"type": "started"}
+    if msg_type == "execution_cached":
+        return {"type": "cached", "nodes": data.get("nodes", [])}
+    if msg_type == "executing":
+        node = data.get("node")
+        return {"type": "executing", "node": node, "class_type": workflow.get(node, {}).get("class_type")}
+    if msg_type == "progress":
+        return {"type": "progress", "node": data.get("node"), "step": data.get("value"), "max": data.get("max")}
+    return None
+
+class SharedImageStore:
+    """Reference-counted shared-memory segments holding encoded input images.
+
+    Segments are named after the image's content hash, so the same image used
+    by several in-flight prompts (e.g. the source face of a batch) is written
+    once and gives ComfyUI identical node inputs, which keeps its cache warm.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segments: Dict[str, list] = {}  # digest -> [SharedMemory, size, refcount]
+
+    def acquire(self, data: bytes, digest: str) -> Dict[str, Any]:
+        """Return loader inputs for `data`, creating its segment if needed."""
+        with self._lock:
+            entry = self._segments.get(digest)
+            if entry is None:
+                name = f"faceswap_{digest[:24]}"
+                try:
+                    shm = shared_memory.SharedMemory(name=name, create=True, size=max(len(data), 1))
+                except FileExistsError:
+                    # Segment orphelin d'un worker précédent: le remplacer
+                    stale = shared_memory.SharedMemory(name=name)
+                    stale.close()
+                    stale.unlink()
+                    shm = shared_memory.SharedMemory(name=name, create=True, size=max(len(data), 1))
+                shm.buf[:len(data)] = data
+                entry = [shm, len(data), 0]
+                self._segments[digest] = entry
+            entry[2] += 1
+            return {"class_type": LOAD_IMAGE_SHM_CLASS, "shm_name": entry[0].name, "size": entry[1]}
+
+    def release(self, digest: str) -> None:
+        with self._lock:
+            entry = self._segments.get(digest)
+            if entry is None:
+                return
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del self._segments[digest]
+                entry[0].close()
+                entry[0].unlink()
+
+
+shared_images = SharedImageStore()
+_detected_transport: Optional[str] = None
+
+def image_transport() -> str:
+    """Effective IMAGE_TRANSPORT; "auto" uses faceswap_io's loaders if ComfyUI loaded them.
+
+    That is "shm" for instances spawned by this process, and "base64" for
+    external ones (COMFYUI_EXTERNAL), which need not share /dev/shm with us.
+
+    Must be called once ComfyUI is up (detection queries /object_info).
+    """
+    global _detected_transport
+    if IMAGE_TRANSPORT != "auto":
+        return IMAGE_TRANSPORT
+    if _detected_transport is None:
+        try:
+            client = comfy_pool.any_ready().client  # Mêmes custom nodes sur toutes les instances
+            available = LOAD_IMAGE_SHM_CLASS in client.get_json(f"/object_info/{LOAD_IMAGE_SHM_CLASS}", timeout=10)
+        except Exception as e:
+            print(f"Image transport detection failed, using files: {str(e)}", file=sys.stderr)
+            available = False
+        if not available:
+            _detected_transport = "file"
+        else:
+            _detected_transport = "base64" if any(instance.external for instance in comfy_pool.instances) else "shm"
+        print(f"Image transport: {_detected_transport}", file=sys.stderr)
         sys.stderr.flush()
-        return False
+    return _detected_transport
+
+def prepare_image_inputs(paths: Dict[str, str], transport: str) -> tuple:
+    """Map image slots to workflow inputs for `transport`.
+
+    Returns (images, acquired): `images` is passed to CompiledWorkflow.instantiate
+    and `acquired` must be handed to release_image_inputs once the prompt is done.
+    """
+    if transport == "file":
+        return dict(paths), []
+    images: Dict[str, Any] = {}
+    acquired: List[str] = []
+    try:
+        for slot, path in paths.items():
+            with open(path, "rb") as f:
+                data = f.read()
+            if transport == "base64":
+                images[slot] = {"class_type": LOAD_IMAGE_BASE64_CLASS, "data": base64.b64encode(data).decode("ascii")}
+            else:
+                digest = hashlib.sha256(data).hexdigest()
+                images[slot] = shared_images.acquire(data, digest)
+                acquired.append(digest)
+    except Exception:
+        release_image_inputs(acquired)
+        raise
+    return images, acquired
+
+def release_image_inputs(acquired: List[str]) -> None:
+    for digest in acquired:
+        shared_images.release(digest)
+
+def output_node_spec(transport: str, output: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Replacement for the SaveImage node(s): results come back over the WebSocket.
+
+    The node encodes straight to the requested output format and size, so
+    no re-encoding is needed in the handler.
+    """
+    if transport == "file":
+        return None
+    return {"class_type": SEND_IMAGE_WS_CLASS, "format": OUTPUT_FORMATS[output["format"]][0],
+            "quality": output["quality"], "max_dim": output["max_dim"] or 0}
 
 # def setup_model_symlinks() -> bool:
 #     """Create symlinks for models from Network Storage"""
@@ -218,12 +1357,1043 @@ def start_comfyui() -> bool:
 #         sys.stderr.flush()
 #         return False
 
+class CompiledWorkflow:
+    """A workflow parsed once, with its injection points resolved.
+
+    `inputs` maps image slots ("image1", "image2") to LoadImage node ids,
+    `outputs` lists the output node ids (first one is the primary output) and
+    `params` maps request parameter names to the (node_id, input_name) pairs
+    they override. `instantiate` builds a per-job prompt by copying only the
+    nodes it patches; every other node is shared with the template and must
+    never be mutated.
+
+    Each quality tier runs a derived graph (see tier_graph): the tier's
+    bypassed nodes are rewired out and everything that does not feed an
+    output node is pruned, so ComfyUI neither validates nor loads it.
+
+    The part of that graph computed from image1 alone (face detection and
+    crop of the source) can be split off: `precompute_graph` runs it on its
+    own, and `instantiate` accepts its outputs as artifacts in place of the
+    frontier nodes (see source_frontier).
+    """
+
+    def __init__(self, name: str, path: str, mtime: float, graph: Dict[str, Any]):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.graph = graph
+        self.inputs = self._resolve_inputs(graph)
+        self.input_max_side = self._resolve_input_sizes(graph, self.inputs)
+        self.outputs = [node_id for node_id, node in graph.items() if node.get("class_type") in OUTPUT_NODE_CLASSES]
+        if not self.outputs and "413" in graph:
+            self.outputs = ["413"]
+        self.params: Dict[str, List[tuple]] = {}
+        for param, (class_type, input_name) in WORKFLOW_PARAM_SLOTS.items():
+            for node_id, node in graph.items():
+                if node.get("class_type") == class_type and input_name in node.get("inputs", {}):
+                    self.params.setdefault(param, []).append((node_id, input_name))
+        self._tier_graphs: Dict[str, Dict[str, Any]] = {}
+        self._source_splits: Dict[str, tuple] = {}
+
+    @property
+    def output_node(self) -> Optional[str]:
+        return self.outputs[0] if self.outputs else None
+
+    @staticmethod
+    def _resolve_inputs(graph: Dict[str, Any]) -> Dict[str, str]:
+        load_nodes = [node_id for node_id, node in graph.items() if node.get("class_type") == "LoadImage"]
+        inputs: Dict[str, str] = {}
+        # 1. Titres des nodes (_meta.title), ex: "Load New Face" = image1
+        for slot, hints in INPUT_TITLE_HINTS.items():
+            for node_id in load_nodes:
+                title = graph[node_id].get("_meta", {}).get("title", "").lower()
+                if node_id not in inputs.values() and any(hint in title for hint in hints):
+                    inputs[slot] = node_id
+                    break
+        # 2. Ordre des LoadImage restants: premier = image1, second = image2
+        remaining = [node_id for node_id in load_nodes if node_id not in inputs.values()]
+        for slot in INPUT_TITLE_HINTS:
+            if slot not in inputs and remaining:
+                inputs[slot] = remaining.pop(0)
+        # 3. Fallback - IDs historiques du workflow faceswap
+        for slot, node_id in (("image1", "240"), ("image2", "431")):
+            if slot not in inputs and node_id in graph:
+                inputs[slot] = node_id
+        return inputs
+
+    @staticmethod
+    def _resolve_input_sizes(graph: Dict[str, Any], inputs: Dict[str, str]) -> Dict[str, Optional[int]]:
+        """Longest side each image slot is used at, or None if the graph uses it at native size.
+
+        A size is only known when every consumer of the slot's loader is a
+        resize node with literal dimensions (see RESIZE_NODE_INPUTS).
+        """
+        sizes: Dict[str, Optional[int]] = {}
+        for slot, load_id in inputs.items():
+            sides: Optional[List[int]] = []
+            for node in graph.values():
+                node_inputs = node.get("inputs", {})
+                if not any(isinstance(value, list) and value and str(value[0]) == load_id for value in node_inputs.values()):
+                    continue
+                dims = [node_inputs.get(name) for name in RESIZE_NODE_INPUTS.get(node.get("class_type"), ())]
+                if not dims or not all(isinstance(dim, int) for dim in dims):
+                    sides = None
+                    break
+                sides.append(max(dims))
+            sizes[slot] = max(sides) if sides else None
+        return sizes
+
+    def tier_graph(self, tier: Optional[str] = None) -> Dict[str, Any]:
+        """The graph run for quality tier `tier` (default QUALITY_TIER), built once per tier.
+
+        Raises KeyError for an unknown tier.
+        """
+        tier = tier or QUALITY_TIER
+        graph = self._tier_graphs.get(tier)
+        if graph is None:
+            graph = self._prune(self._bypass(self.graph, QUALITY_TIERS[tier]["bypass"]), self.outputs)
+            self._tier_graphs[tier] = graph
+            logger.info(f"Workflow '{self.name}' tier '{tier}': {len(graph)}/{len(self.graph)} nodes kept")
+        return graph
+
+    def source_frontier(self, tier: Optional[str] = None) -> List[str]:
+        """Nodes computed from image1 alone whose output feeds the per-job part of the graph.
+
+        A node is per-job if it depends on another image slot or is the
+        target of a request parameter. Empty when the graph cannot be split:
+        every frontier node must be in SOURCE_ARTIFACT_CLASSES and be
+        consumed through its IMAGE output (slot 0) only.
+        """
+        return self._source_split(tier)[0]
+
+    def source_fingerprint(self, tier: Optional[str] = None) -> str:
+        """Hash of the precompute graph: artifacts are only valid for the graph that produced them."""
+        return self._source_split(tier)[1]
+
+    def _source_split(self, tier: Optional[str]) -> tuple:
+        tier = tier or QUALITY_TIER
+        split = self._source_splits.get(tier)
+        if split is not None:
+            return split
+        graph = self.tier_graph(tier)
+        source = self.inputs.get("image1")
+        links = {node_id: [(str(value[0]), value[1]) for value in node.get("inputs", {}).values()
+                           if isinstance(value, list) and value and str(value[0]) in graph]
+                 for node_id, node in graph.items()}
+        per_job = {node_id for slot, node_id in self.inputs.items() if slot != "image1"}
+        per_job |= {node_id for targets in self.params.values() for node_id, _ in targets}
+        from_source = {source} if source in graph else set()
+        changed = bool(from_source)
+        while changed:
+            changed = False
+            for node_id, node_links in links.items():
+                upstream = {link for link, _ in node_links}
+                if node_id not in per_job and upstream & per_job:
+                    per_job.add(node_id)
+                    changed = True
+                if node_id not in from_source and upstream & from_source:
+                    from_source.add(node_id)
+                    changed = True
+        identity = from_source - per_job - {source}
+        consumers: Dict[str, List[tuple]] = {}
+        for node_id, node_links in links.items():
+            if node_id not in identity:
+                for link, output in node_links:
+                    if link in identity:
+                        consumers.setdefault(link, []).append(output)
+        frontier = sorted(consumers)
+        if any(graph[node_id].get("class_type") not in SOURCE_ARTIFACT_CLASSES or set(consumers[node_id]) != {0}
+               for node_id in frontier):
+            frontier = []
+        subgraph = self._prune(graph, frontier) if frontier else {}
+        placeholder = {**subgraph, source: {**graph[source], "inputs": {"image": "<image1>"}}} if frontier else {}
+        fingerprint = hashlib.sha256(json.dumps(placeholder, sort_keys=True).encode("utf-8")).hexdigest()
+        split = (frontier, fingerprint)
+        self._source_splits[tier] = split
+        if frontier:
+            logger.info(f"Workflow '{self.name}' tier '{tier}': source precompute frontier {frontier} "
+                        f"({len(subgraph)} nodes)")
+        return split
+
+    def precompute_graph(self, image1: Any, output_node: Dict[str, Any], tier: Optional[str] = None) -> Dict[str, Any]:
+        """Prompt running only the source subgraph, one `output_node` on each frontier node.
+
+        The output node added for frontier node N has id "N_artifact".
+        """
+        frontier = self.source_frontier(tier)
+        prompt = dict(self._prune(self.tier_graph(tier), frontier))
+        source = self.inputs["image1"]
+        if isinstance(image1, dict):
+            prompt[source] = {"inputs": {k: v for k, v in image1.items() if k != "class_type"},
+                              "class_type": image1["class_type"], "_meta": prompt[source].get("_meta", {})}
+        else:
+            prompt[source] = {**prompt[source], "inputs": {**prompt[source]["inputs"], "image": image1}}
+        for node_id in frontier:
+            inputs = {name: value for name, value in output_node.items() if name != "class_type"}
+            prompt[f"{node_id}_artifact"] = {"inputs": {**inputs, "images": [node_id, 0]},
+                                             "class_type": output_node["class_type"]}
+        return prompt
+
+    def tier_params(self, tier: Optional[str], params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Request params over the tier's defaults (those this workflow has)."""
+        defaults = QUALITY_TIERS[tier or QUALITY_TIER]["params"]
+        return {**{param: value for param, value in defaults.items() if param in self.params}, **(params or {})}
+
+    @staticmethod
+    def _bypass(graph: Dict[str, Any], class_types: tuple) -> Dict[str, Any]:
+        """Copy of `graph` where consumers of the `class_types` nodes read those nodes' input instead."""
+        sources = {}
+        for node_id, node in graph.items():
+            input_name = BYPASS_NODE_INPUTS.get(node.get("class_type"))
+            link = node.get("inputs", {}).get(input_name) if node.get("class_type") in class_types else None
+            if isinstance(link, list) and link:
+                sources[node_id] = link
+        if not sources:
+            return graph
+        result = dict(graph)
+        for node_id, node in graph.items():
+            rewired = {}
+            for name, value in node.get("inputs", {}).items():
+                if isinstance(value, list) and value and str(value[0]) in sources:
+                    # Nodes court-circuités en chaîne: remonter jusqu'à la vraie source
+                    while isinstance(value, list) and value and str(value[0]) in sources:
+                        value = sources[str(value[0])]
+                    rewired[name] = list(value)
+            if rewired:
+                result[node_id] = {**node, "inputs": {**node["inputs"], **rewired}}
+        return result
+
+    @staticmethod
+    def _prune(graph: Dict[str, Any], outputs: List[str]) -> Dict[str, Any]:
+        """Only the nodes `outputs` depend on (the whole graph if it has no output node)."""
+        if not outputs:
+            return graph
+        keep = set()
+        stack = [node_id for node_id in outputs if node_id in graph]
+        while stack:
+            node_id = stack.pop()
+            if node_id in keep:
+                continue
+            keep.add(node_id)
+            for value in graph[node_id].get("inputs", {}).values():
+                if isinstance(value, list) and value and str(value[0]) in graph:
+                    stack.append(str(value[0]))
+        return {node_id: node for node_id, node in graph.items() if node_id in keep}
+
+    def validate_params(self, params: Optional[Dict[str, Any]]) -> None:
+        """Raise ValueError if `params` is not an object of scalar values or names a parameter this workflow lacks."""
+        if params is not None and not isinstance(params, dict):
+            raise ValueError("'params' must be an object")
+        for param, value in (params or {}).items():
+            if param not in self.params:
+                raise ValueError(f"Workflow '{self.name}' has no parameter '{param}' (available: {sorted(self.params)})")
+            # Une liste serait lue par ComfyUI comme un lien vers un autre node
+            if not isinstance(value, (str, int, float, bool)):
+                raise ValueError(f"Parameter '{param}' must be a string, number or boolean")
+
+    def instantiate(self, images: Dict[str, Any], params: Optional[Dict[str, Any]] = None,
+                    output_node: Optional[Dict[str, Any]] = None, tier: Optional[str] = None) -> Dict[str, Any]:
+        """Return a prompt graph with images and params injected.
+
+        An image value is either a path for the LoadImage node or a dict
+        {"class_type": ..., **inputs} replacing that node (in-memory loaders).
+        `images` may also be keyed by source_frontier() node ids: that node is
+        then loaded from the artifact image instead of being computed, and the
+        source subgraph it replaces is pruned. `output_node` likewise replaces
+        the class and literal inputs of the output nodes, keeping their
+        "images" link. The prompt is built from the graph of quality tier
+        `tier`, whose default params apply unless overridden by `params`;
+        targets pruned from that graph are skipped.
+        Raises ValueError for an unknown image slot or parameter.
+        """
+        self.validate_params(params)
+        base = self.tier_graph(tier)
+        params = self.tier_params(tier, params)
+        prompt = dict(base)
+
+        def patch(node_id: str, input_name: str, value: Any) -> None:
+            if node_id not in prompt:
+                return
+            node = prompt[node_id]
+            if node is base[node_id]:
+                node = dict(node)
+                node["inputs"] = dict(node["inputs"])
+                prompt[node_id] = node
+            node["inputs"][input_name] = value
+
+        def replace(node_id: str, spec: Dict[str, Any], keep: tuple = ()) -> None:
+            if node_id not in prompt:
+                return
+            node = base[node_id]
+            inputs = {name: node["inputs"][name] for name in keep if name in node["inputs"]}
+            inputs.update({name: value for name, value in spec.items() if name != "class_type"})
+            prompt[node_id] = {"inputs": inputs, "class_type": spec["class_type"], "_meta": node.get("_meta", {})}
+
+        artifacts = False
+        for slot, value in images.items():
+            if slot in self.inputs:
+                node_id = self.inputs[slot]
+            elif slot in self.source_frontier(tier):
+                node_id, artifacts = slot, True
+                value = value if isinstance(value, dict) else {"class_type": "LoadImage", "image": value}
+            else:
+                raise ValueError(f"Workflow '{self.name}' has no input slot '{slot}'")
+            if isinstance(value, dict):
+                replace(node_id, value)
+            else:
+                patch(node_id, "image", value)
+        for param, value in params.items():
+            for node_id, input_name in self.params[param]:
+                patch(node_id, input_name, value)
+        if output_node is not None:
+            for node_id in self.outputs:
+                replace(node_id, output_node, keep=("images",))
+        if artifacts:
+            # Détection/crop de la source remplacés par leurs artefacts: ne plus les exécuter
+            prompt = self._prune(prompt, self.outputs)
+        return prompt
+
+
+class WorkflowRegistry:
+    """Named workflows compiled once and recompiled when the file's mtime changes.
+
+    The mtime is checked at most every `reload_interval` seconds, so the hot
+    path normally does no file I/O at all.
+    """
+
+    def __init__(self, paths: Dict[str, str], default: str, reload_interval: float = 5.0):
+        self.paths = paths
+        self.default = default
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._compiled: Dict[str, CompiledWorkflow] = {}
+        self._checked: Dict[str, float] = {}
+
+    def names(self) -> List[str]:
+        return list(self.paths)
+
+    def get(self, name: Optional[str] = None) -> CompiledWorkflow:
+        """Return the compiled workflow `name` (default workflow if None).
+
+        Raises KeyError for an unknown name and OSError/ValueError if the file
+        cannot be read or parsed.
+        """
+        name = name or self.default
+        if not isinstance(name, str) or name not in self.paths:
+            raise KeyError(f"Unknown workflow '{name}' (available: {self.names()})")
+        now = time.monotonic()
+        compiled = self._compiled.get(name)
+        if compiled is not None and now - self._checked.get(name, 0.0) < self.reload_interval:
+            return compiled
+        with self._lock:
+            compiled = self._compiled.get(name)
+            path = self.paths[name]
+            mtime = os.stat(path).st_mtime
+            if compiled is None or compiled.mtime != mtime:
+                with open(path, "r", encoding="utf-8") as f:
+                    graph = json.load(f)
+                compiled = CompiledWorkflow(name, path, mtime, graph)
+                self._compiled[name] = compiled
+                logger.info(f"Compiled workflow '{name}' from {path}: {len(graph)} nodes, "
+                            f"inputs={compiled.inputs}, outputs={compiled.outputs}, params={sorted(compiled.params)}")
+            self._checked[name] = now
+            return compiled
+
+    def preload(self) -> None:
+        """Compile every registered workflow, logging (not raising) failures."""
+        for name in self.paths:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.error(f"Error compiling workflow '{name}': {e}")
+
+
+def _parse_workflows(spec: str) -> Dict[str, str]:
+    """Parse "name=path,name=path" into a dict, keeping the default workflow first."""
+    paths = {"default": WORKFLOW_PATH}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, path = item.partition("=")
+        paths[name.strip()] = path.strip()
+    return paths
+
+
+workflow_registry = WorkflowRegistry(_parse_workflows(WORKFLOWS), "default", WORKFLOW_RELOAD_INTERVAL)
+workflow_registry.preload()
+
+class DiskLRUCache:
+    """Size-capped on-disk LRU cache of opaque byte blobs.
+
+    Entries are plain files named after their key, written atomically
+    (temp file + rename) so several workers can share one directory on
+    network storage. Reads bump the file's mtime, and the least recently
+    used files are deleted once the directory grows past `max_bytes`.
+
+    The directory is only listed when needed: writes add to a running size
+    estimate, and a scan (which also sees other workers' entries) runs on
+    the first write and whenever the estimate passes `max_bytes`; it
+    evicts down to LOW_WATER of the budget so the next writes have room.
+    """
+
+    LOW_WATER = 0.9
+
+    def __init__(self, root: str, max_bytes: int, suffix: str = ".bin"):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._total: Optional[int] = None  # Taille estimée du dossier, None = pas encore scanné
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.root, key + self.suffix)
+
+    def get_path(self, key: str) -> Optional[str]:
+        """Like get(), but return the entry's path instead of reading it."""
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = f"{self.path_for(key)}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path_for(key))
+            with self._lock:
+                if self._total is not None:
+                    self._total += len(data)  # Surestimé si la clé existait: au pire un scan plus tôt
+                scan = self._total is None or self._total > self.max_bytes
+            if scan:
+                self._evict()
+        except OSError as e:
+            logger.warning(f"Cache write failed in {self.root}: {e}")
+
+    def _evict(self) -> None:
+        entries = []
+        total = 0
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total > self.max_bytes:
+            target = int(self.max_bytes * self.LOW_WATER)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+        with self._lock:
+            self._total = total
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def file_sha256(path: str) -> str:
+    """Hex SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def result_cache_key(image_hashes: Dict[str, str], template: "CompiledWorkflow",
+                     params: Optional[Dict[str, Any]], output: Dict[str, Any], preprocess: str = "off",
+                     tier: Optional[str] = None) -> str:
+    """Content address of a job: input bytes and preprocessing, patched (tier) workflow and output options.
+
+    Image slots are replaced by placeholders before fingerprinting so the key
+    depends on the image content, not on where the files happen to live.
+    """
+    placeholders = {slot: f"<{slot}>" for slot in image_hashes}
+    fingerprint = json.dumps(template.instantiate(placeholders, params, tier=tier), sort_keys=True, separators=(",", ":"))
+    material = json.dumps({
+        "images": image_hashes,
+        "workflow": hashlib.sha256(fingerprint.encode("utf-8")).hexdigest(),
+        "output": output,
+        "preprocess": preprocess,
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+result_cache = DiskLRUCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, suffix=".json")
+source_cache = DiskLRUCache(SOURCE_CACHE_DIR, SOURCE_CACHE_MAX_BYTES, suffix=".png")
+
+class InputPreprocessor:
+    """Normalizes client images before they reach ComfyUI.
+
+    Applies the EXIF orientation, drops metadata, downscales to the longest
+    side the workflow uses and re-encodes as JPEG; JPEGs are decoded directly
+    at reduced scale. Normalized files live in a DiskLRUCache keyed by content
+    hash and settings. An in-memory memo keyed by (path, size, mtime) skips
+    re-hashing images repeated across jobs, like a batch's source face.
+    Images that need none of this are passed through untouched.
+    """
+
+    PASSTHROUGH_FORMATS = {"JPEG", "PNG", "WEBP"}
+    EXIF_ORIENTATION = 0x0112
+
+    def __init__(self, cache: DiskLRUCache, max_side: int, quality: int, memo_size: int = 1024):
+        self.cache = cache
+        self.max_side = max_side
+        self.quality = quality
+        self.memo_size = memo_size
+        self._lock = threading.Lock()
+        self._memo: "OrderedDict[tuple, str]" = OrderedDict()
+
+    def target_side(self, template: "CompiledWorkflow", slot: str, cap: Optional[int] = None) -> int:
+        """Longest side for `slot`, at most `cap` (a quality tier's resolution); 0 = unlimited.
+
+        Without a resolution derived from the workflow, `max_side` applies
+        (opt-in): the bundled graphs paste the face back into the target at
+        its native resolution, which must not be silently reduced.
+        """
+        side = template.input_max_side.get(slot) or self.max_side
+        if not cap:
+            return side
+        return min(side, cap) if side else cap
+
+    def signature(self, template: "CompiledWorkflow", cap: Optional[int] = None) -> str:
+        """Settings that change the normalized pixels (part of the result cache key)."""
+        sides = ",".join(f"{slot}={self.target_side(template, slot, cap)}" for slot in sorted(template.inputs))
+        return f"{sides};q={self.quality}"
+
+    def normalize(self, path: str, max_side: int) -> str:
+        """Return the path of the normalized image (may be `path` itself).
+
+        Raises OSError (incl. PIL.UnidentifiedImageError) for unreadable images.
+        """
+        stat = os.stat(path)
+        memo_key = (path, stat.st_size, stat.st_mtime_ns, max_side)
+        with self._lock:
+            memoized = self._memo.get(memo_key)
+            if memoized is not None:
+                self._memo.move_to_end(memo_key)
+        if memoized is not None and os.path.exists(memoized):
+            return memoized
+
+        key = hashlib.sha256(f"{file_sha256(path)}:{max_side}:{self.quality}".encode("utf-8")).hexdigest()
+        normalized = self.cache.get_path(key)
+        if normalized is None:
+            data = self._reencode(path, max_side)
+            normalized = path
+            if data is not None:
+                self.cache.put(key, data)
+                if os.path.exists(self.cache.path_for(key)):
+                    normalized = self.cache.path_for(key)
+                    print(f"Preprocessed {path}: {stat.st_size} -> {len(data)} bytes", file=sys.stderr)
+                    sys.stderr.flush()
+
+        with self._lock:
+            self._memo[memo_key] = normalized
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return normalized
+
+    def _reencode(self, path: str, max_side: int) -> Optional[bytes]:
+        """Encoded normalized image, or None if `path` can be used as is."""
+        with Image.open(path) as img:
+            max_side = max_side or max(img.size)  # 0: orientation et métadonnées seulement
+            orientation = img.getexif().get(self.EXIF_ORIENTATION, 1)
+            if img.format in self.PASSTHROUGH_FORMATS and orientation == 1 and max(img.size) <= max_side:
+                return None
+            if img.format == "JPEG":
+                img.draft("RGB", (max_side, max_side))  # Décodage DCT à l'échelle réduite: 4-8x plus rapide
+            image = ImageOps.exif_transpose(img).convert("RGB")
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=self.quality, optimize=True)
+        return out.getvalue()
+
+
+input_preprocessor = InputPreprocessor(DiskLRUCache(PREPROCESS_CACHE_DIR, PREPROCESS_CACHE_MAX_BYTES, suffix=".jpg"),
+                                       PREPROCESS_MAX_SIDE, PREPROCESS_QUALITY)
+
+def preprocessing_enabled(input_data: Dict[str, Any]) -> bool:
+    return PREPROCESS_ENABLED and input_data.get("preprocess", True)
+
+def quality_tier(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Settings of the request's quality tier ("quality", default QUALITY_TIER)."""
+    return QUALITY_TIERS[input_data.get("quality") or QUALITY_TIER]
+
+def preprocess_inputs(paths: Dict[str, str], template: "CompiledWorkflow", input_data: Dict[str, Any]) -> Dict[str, str]:
+    """Normalized copies of a job's images (see InputPreprocessor); the originals when disabled.
+
+    The quality tier's "max_side" caps the resolution the images are submitted at.
+    """
+    if not preprocessing_enabled(input_data):
+        return dict(paths)
+    cap = quality_tier(input_data)["max_side"]
+    return {slot: input_preprocessor.normalize(path, input_preprocessor.target_side(template, slot, cap))
+            for slot, path in paths.items()}
+
+OUTPUT_FORMATS = {"png": ("PNG", "png", "image/png"), "jpeg": ("JPEG", "jpg", "image/jpeg"),
+                  "webp": ("WEBP", "webp", "image/webp")}  # format -> (nom Pillow, extension, type MIME)
+
+def parse_output_options(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalized "output" options of a request: format, quality, max_dim and mode.
+
+    The legacy top-level "output_format" is accepted as the format.
+    Raises ValueError for invalid values.
+    """
+    spec = input_data.get("output") or {}
+    if not isinstance(spec, dict):
+        raise ValueError("'output' must be an object")
+    fmt = str(spec.get("format", input_data.get("output_format", "png"))).lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format '{fmt}' (available: {sorted(OUTPUT_FORMATS)})")
+    quality = spec.get("quality", 90)
+    if isinstance(quality, bool) or not isinstance(quality, int) or not 1 <= quality <= 100:
+        raise ValueError("'output.quality' must be an integer between 1 and 100")
+    max_dim = spec.get("max_dim")
+    if max_dim is not None and (isinstance(max_dim, bool) or not isinstance(max_dim, int) or max_dim <= 0):
+        raise ValueError("'output.max_dim' must be a positive integer")
+    mode = spec.get("mode", OUTPUT_MODE)
+    if mode not in ("inline", "reference"):
+        raise ValueError("'output.mode' must be 'inline' or 'reference'")
+    return {"format": fmt, "quality": quality, "max_dim": max_dim, "mode": mode}
+
+class OutputEncoder:
+    """Re-encodes result images to the requested format, quality and size.
+
+    Work runs on a bounded thread pool shared by all jobs, so concurrent
+    jobs cannot oversubscribe the CPU with image encoding. PNGs that need
+    no change are returned without being decoded.
+    """
+
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="output-encode")
+
+    def encode_many(self, images: List[tuple], options: Dict[str, Any]) -> List[tuple]:
+        """[(data, format)] -> [(data, format)] in the requested output format."""
+        return list(self._executor.map(lambda image: self.encode(*image, options), images))
+
+    @staticmethod
+    def encode(data: bytes, fmt: str, options: Dict[str, Any]) -> tuple:
+        target, max_dim = options["format"], options["max_dim"]
+        if fmt == target == "png" and not max_dim:
+            return data, fmt
+        with Image.open(io.BytesIO(data)) as img:
+            if fmt == target == "png" and (not max_dim or max(img.size) <= max_dim):
+                return data, fmt
+            image = img.convert("RGB") if target == "jpeg" else img.copy()
+        if max_dim and max(image.size) > max_dim:
+            image.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        if target == "png":
+            image.save(out, "PNG", compress_level=4)
+        else:
+            image.save(out, OUTPUT_FORMATS[target][0], quality=options["quality"])
+        return out.getvalue(), target
+
+
+class ObjectStore(abc.ABC):
+    """Destination of reference-mode outputs.
+
+    Backends implement put(); the returned dict tells the client where the
+    object is and is merged into the result entry next to its size and
+    checksum. Register new backends in OUTPUT_STORES.
+    """
+
+    @abc.abstractmethod
+    def put(self, key: str, data: bytes, content_type: str) -> Dict[str, Any]:
+        """Store `data` under `key`; returns the location fields of the result entry."""
+
+
+class LocalFileStore(ObjectStore):
+    """Writes outputs as files under `root`, typically the network volume the client also mounts."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def put(self, key: str, data: bytes, content_type: str) -> Dict[str, Any]:
+        path = os.path.join(self.root, key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return {"key": key, "path": path}
+
+
+OUTPUT_STORES = {"local": LocalFileStore}
+output_encoder = OutputEncoder(OUTPUT_ENCODE_WORKERS)
+output_store: ObjectStore = OUTPUT_STORES[OUTPUT_STORE](OUTPUT_STORE_DIR)
+
+def deliver_outputs(images: List[tuple], options: Dict[str, Any], trace: "JobTrace", encoded: bool = False) -> List[Any]:
+    """Turn raw result images [(data, format)] into response entries.
+
+    Entries are base64 strings in "inline" mode and object-store references
+    ({"key", "path", "bytes", "sha256", "format"}) in "reference" mode; the
+    internal "raw" mode (sequence jobs) keeps the encoded bytes.
+    `encoded` means the images already match `options` (encoded by ComfyUI).
+    """
+    if not encoded:
+        with trace.stage("transcode"):
+            images = output_encoder.encode_many(images, options)
+    entries: List[Any] = []
+    for data, fmt in images:
+        if options["mode"] == "reference":
+            digest = hashlib.sha256(data).hexdigest()
+            _, extension, content_type = OUTPUT_FORMATS[fmt]
+            # Clé adressée par contenu: un résultat identique n'est écrit qu'une fois
+            with trace.stage("store"):
+                ref = output_store.put(f"{digest[:2]}/{digest}.{extension}", data, content_type)
+            entry = {**ref, "bytes": len(data), "sha256": digest, "format": fmt}
+        elif options["mode"] == "raw":
+            entry = data
+        else:
+            with trace.stage("encode"):
+                entry = base64.b64encode(data).decode('utf-8')
+        trace.bytes_out += output_entry_size(entry)
+        entries.append(entry)
+    return entries
+
+def output_entry_size(entry: Any) -> int:
+    """Bytes an output entry adds to the response payload."""
+    return len(entry) if isinstance(entry, (str, bytes)) else len(json.dumps(entry))
+
+def pop_cached_entries(cached: Dict[str, Any]) -> List[Any]:
+    """Remove and return the output entries of a cached result, whichever mode stored them."""
+    return cached.pop("output_images", None) or cached.pop("output_refs", None) or []
+
+def output_event(node_id: str, index: int, entry: Any) -> Dict[str, Any]:
+    """Streaming event for one delivered output entry."""
+    if isinstance(entry, dict):
+        return {"type": "image", "node": node_id, "index": index, "ref": entry}
+    return {"type": "image", "node": node_id, "index": index, "image": entry}
+
+class JobDeadline:
+    """Time budget of one job, shared by every prompt it submits.
+
+    Waits are bounded by `remaining()`; `cancelled` is set when the caller
+    gives up (e.g. RunPod cancels the request). In both cases the job's
+    prompts are removed from ComfyUI (see cancel_prompt).
+    """
+
+    def __init__(self, timeout: float, cancelled: Optional[threading.Event] = None):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+        self.cancelled = cancelled or threading.Event()
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.cancelled.is_set() or time.monotonic() >= self.expires
+
+    def error(self) -> Dict[str, Any]:
+        """Response for work that was not started because the job is over."""
+        if self.cancelled.is_set():
+            return {"status": "error", "error": "Job cancelled"}
+        return {"status": "error", "error": f"Job deadline of {self.timeout:.0f} seconds exceeded"}
+
+    def check(self) -> None:
+        """Raise JobCancelled or DeadlineExceeded if the job is over."""
+        if self.cancelled.is_set():
+            raise JobCancelled("Job cancelled")
+        if time.monotonic() >= self.expires:
+            raise DeadlineExceeded(f"Job deadline of {self.timeout:.0f} seconds exceeded")
+
+
+class JobTrace:
+    """Monotonic per-stage timings of one job, plus per-node execution times.
+
+    Handler stages are measured with `stage()`. ComfyUI WebSocket events fed
+    to `on_event()` give the queue wait (submit -> execution_start), the
+    execution time and each node's duration (time between consecutive
+    "executing" events).
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages: Dict[str, float] = {}
+        self.nodes: Dict[str, float] = {}
+        self.bytes_out = 0
+        self.prompts = 0  # Prompts exécutés jusqu'au bout
+        self._submitted: Optional[float] = None
+        self._exec_start: Optional[float] = None
+        self._node: Optional[str] = None
+        self._node_start = 0.0
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def submitted(self) -> None:
+        self._submitted = time.monotonic()
+        self._exec_start = None
+
+    def on_event(self, message: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        msg_type = message["type"]
+        if msg_type in ("execution_start", "executing") and self._exec_start is None:
+            self._exec_start = now
+            if self._submitted is not None:
+                self.add("queue_wait", now - self._submitted)
+        if msg_type == "executing":
+            self._close_node(now)
+            self._node = message["data"].get("node")
+            self._node_start = now
+
+    def finished(self) -> None:
+        """Close the timings of a prompt whose execution just completed."""
+        now = time.monotonic()
+        self._close_node(now)
+        if self._exec_start is not None:
+            self.add("execution", now - self._exec_start)
+            self.prompts += 1
+        self._submitted = None
+
+    def _close_node(self, now: float) -> None:
+        if self._node is not None:
+            self.nodes[self._node] = self.nodes.get(self._node, 0.0) + now - self._node_start
+            self._node = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "total_ms": round((time.monotonic() - self.start) * 1000, 1),
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "nodes_ms": {node: round(seconds * 1000, 1) for node, seconds in self.nodes.items()},
+            "bytes_out": self.bytes_out,
+        }
+
+
+class JobMetrics:
+    """Rolling latency histograms and throughput over the last jobs.
+
+    Keeps the last `window` samples per stage (fixed memory) and the
+    completion times of recent jobs for the jobs/sec rate.
+    """
+
+    def __init__(self, window: int = 500, rate_window: float = 60.0):
+        self.window = window
+        self.rate_window = rate_window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self._completed: deque = deque()
+        self.jobs = 0
+        self.errors = 0
+        self.bytes_out = 0
+
+    def record(self, trace: JobTrace, status: str) -> None:
+        now = time.monotonic()
+        samples = dict(trace.stages, total=now - trace.start)
+        with self._lock:
+            for name, seconds in samples.items():
+                self._samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+            self._completed.append(now)
+            while self._completed and now - self._completed[0] > self.rate_window:
+                self._completed.popleft()
+            self.jobs += 1
+            self.errors += status == "error"
+            self.bytes_out += trace.bytes_out
+
+    @staticmethod
+    def _percentile(values: List[float], q: float) -> float:
+        index = min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))
+        return values[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            recent = sum(1 for t in self._completed if now - t <= self.rate_window)
+            totals = {"jobs": self.jobs, "errors": self.errors, "bytes_out": self.bytes_out}
+        return {
+            **totals,
+            "jobs_per_sec": round(recent / self.rate_window, 3),
+            "stages_ms": {
+                name: {
+                    "count": len(values),
+                    "p50": round(self._percentile(values, 0.50) * 1000, 1),
+                    "p95": round(self._percentile(values, 0.95) * 1000, 1),
+                    "p99": round(self._percentile(values, 0.99) * 1000, 1),
+                }
+                for name, values in samples.items() if values
+            },
+        }
+
+
+job_metrics = JobMetrics(METRICS_WINDOW)
+
+
+class AdmissionController:
+    """Decides whether a new job can still meet its deadline, given the work queued in ComfyUI.
+
+    Learns the execution time of one prompt per (workflow, quality tier)
+    from recent successful jobs. The queue ahead of a new job is the load
+    of the ready instances (our in-flight prompts and, through ComfyUI's
+    status events, everyone else's queue), worked off in parallel. Jobs
+    that would wait in that queue and still miss their deadline are
+    rejected with a retry hint instead of being queued to fail. The same
+    estimate sizes the concurrency advertised to RunPod.
+    """
+
+    def __init__(self, window: int = 50, min_samples: int = 5):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples: Dict[tuple, deque] = {}
+        self._all: deque = deque(maxlen=window)
+        self.rejected = 0
+
+    def record(self, key: tuple, trace: JobTrace) -> None:
+        """Learn from a successful job's execution time per prompt."""
+        if not trace.prompts or "execution" not in trace.stages:
+            return
+        seconds = trace.stages["execution"] / trace.prompts
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+            self._all.append(seconds)
+
+    def estimate(self, key: Optional[tuple] = None) -> Optional[float]:
+        """Median seconds per prompt for `key` (any job if unknown), None until enough samples."""
+        with self._lock:
+            samples = self._samples.get(key) if key is not None else None
+            if not samples or len(samples) < self.min_samples:
+                samples = self._all
+            if len(samples) < self.min_samples:
+                return None
+            return sorted(samples)[len(samples) // 2]
+
+    def queue_wait(self, per_prompt: float) -> float:
+        """Expected wait before a new prompt starts, with the ready instances draining in parallel."""
+        ready = comfy_pool.ready_instances()
+        if not ready:
+            return 0.0
+        return sum(instance.load() for instance in ready) / len(ready) * per_prompt
+
+    def check(self, key: tuple, prompts: int, deadline: JobDeadline) -> Optional[Dict[str, Any]]:
+        """None if a job of `prompts` prompts can be admitted, else its error response.
+
+        Only the queue ahead is grounds for refusal: an idle worker takes
+        every job, however long it looks.
+        """
+        if not ADMISSION_CONTROL:
+            return None
+        per_prompt = self.estimate(key)
+        if per_prompt is None:
+            return None
+        wait = self.queue_wait(per_prompt)
+        completion = wait + prompts * per_prompt
+        if wait <= 0 or completion <= deadline.remaining():
+            return None
+        with self._lock:
+            self.rejected += 1
+        retry_after = round(completion - deadline.remaining(), 1)
+        print(f"Admission refused: ~{completion:.0f}s needed ({wait:.0f}s queued), "
+              f"{deadline.remaining():.0f}s left", file=sys.stderr)
+        sys.stderr.flush()
+        return {
+            "status": "error",
+            "error": "Worker overloaded: the job would not finish before its deadline",
+            "estimated_wait": round(wait, 1),
+            "estimated_completion": round(completion, 1),
+            "retry_after": retry_after,
+        }
+
+    def capacity(self, limit: int, timeout: float) -> int:
+        """Jobs worth accepting at once: as many single prompts as the ready instances finish within `timeout`.
+
+        Work queued by other ComfyUI clients is deducted. Without an
+        estimate (cold worker) the configured `limit` applies.
+        """
+        per_prompt = self.estimate()
+        ready = comfy_pool.ready_instances()
+        if per_prompt is None or not ready:
+            return limit
+        external = sum(max(0, (instance.events.queue_remaining or 0) - instance.events.pending()) for instance in ready)
+        return max(1, min(limit, int(timeout * len(ready) / per_prompt) - external))
+
+    def snapshot(self) -> Dict[str, Any]:
+        per_prompt = self.estimate()
+        return {
+            "enabled": ADMISSION_CONTROL,
+            "seconds_per_prompt": round(per_prompt, 2) if per_prompt is not None else None,
+            "queue_wait_s": round(self.queue_wait(per_prompt), 1) if per_prompt is not None else None,
+            "capacity": self.capacity(MAX_CONCURRENCY, EXECUTION_TIMEOUT),
+            "rejected": self.rejected,
+        }
+
+
+admission = AdmissionController(ADMISSION_WINDOW, ADMISSION_MIN_SAMPLES)
+
+def admission_key(input_data: Dict[str, Any]) -> tuple:
+    return input_data.get("workflow") or "default", input_data.get("quality") or QUALITY_TIER
+
 def validate_input(input_data: Dict[str, Any]) -> Dict[str, Any]:
     """Validate input data with detailed error messages"""
     errors = []
     
     # Log actual input for debugging
     logger.info(f"Validating input: {json.dumps(input_data, indent=2)}")
+
+    timeout = input_data.get("timeout")
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+        return {"valid": False, "errors": ["'timeout' must be a positive number of seconds"]}
+    try:
+        parse_output_options(input_data)
+    except ValueError as e:
+        return {"valid": False, "errors": [str(e)]}
+    quality = input_data.get("quality")
+    if quality is not None and (not isinstance(quality, str) or quality not in QUALITY_TIERS):
+        return {"valid": False, "errors": [f"Unknown quality tier '{input_data['quality']}' (available: {sorted(QUALITY_TIERS)})"]}
+
+    # Sequence mode: image1_path + frames (dossier, archive ou vidéo)
+    if "sequence" in input_data:
+        return validate_sequence_input(input_data)
+
+    # Batch mode: image1_path + "targets", or explicit "pairs"
+    if "targets" in input_data or "pairs" in input_data:
+        return validate_batch_input(input_data)
     
     # Check if image1_path exists in input
     if "image1_path" not in input_data:
@@ -257,32 +2427,107 @@ def validate_input(input_data: Dict[str, Any]) -> Dict[str, Any]:
     
     return {"valid": True, "data": input_data}
 
+def validate_batch_input(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate a batch job and normalize it to input_data["items"].
+
+    Only the structure is checked here: a missing image fails its own item,
+    not the whole batch.
+    """
+    errors = []
+    items = []
+    if "pairs" in input_data:
+        pairs = input_data["pairs"]
+        if not isinstance(pairs, list) or not pairs:
+            errors.append("'pairs' must be a non-empty list")
+        else:
+            for index, pair in enumerate(pairs):
+                if not isinstance(pair, dict) or "image1_path" not in pair or "image2_path" not in pair:
+                    errors.append(f"pairs[{index}] must contain 'image1_path' and 'image2_path'")
+                else:
+                    items.append({"image1_path": pair["image1_path"], "image2_path": pair["image2_path"]})
+    else:
+        targets = input_data["targets"]
+        if "image1_path" not in input_data:
+            errors.append("Image 1 path ('image1_path') is required with 'targets'")
+        elif not isinstance(targets, list) or not targets:
+            errors.append("'targets' must be a non-empty list of image paths")
+        else:
+            items = [{"image1_path": input_data["image1_path"], "image2_path": target} for target in targets]
+
+    if len(items) > MAX_BATCH_SIZE:
+        errors.append(f"Batch too large: {len(items)} items (max {MAX_BATCH_SIZE})")
+
+    if errors:
+        return {"valid": False, "errors": errors}
+
+    return {"valid": True, "data": {**input_data, "items": items}}
+
+def validate_sequence_input(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate a sequence job: image1_path plus "sequence": {path, output_path?, fps?, dedup_threshold?, window?}."""
+    errors = []
+    spec = input_data["sequence"]
+    if "image1_path" not in input_data:
+        errors.append("Image 1 path ('image1_path') is required with 'sequence'")
+    elif not os.path.exists(input_data["image1_path"]):
+        errors.append(f"Image 1 doesn't exist at path: {input_data['image1_path']}")
+    if not isinstance(spec, dict) or "path" not in spec:
+        return {"valid": False, "errors": errors + ["'sequence' must be an object with a 'path'"]}
+    if not os.path.exists(spec["path"]):
+        errors.append(f"Sequence doesn't exist at path: {spec['path']}")
+    output_path = spec.get("output_path")
+    if output_path is not None and not isinstance(output_path, str):
+        errors.append("'sequence.output_path' must be a path")
+    elif output_path and os.path.splitext(output_path)[1] and os.path.splitext(output_path)[1].lower() not in VIDEO_CODECS:
+        errors.append(f"Unsupported video format for 'sequence.output_path' (available: {sorted(VIDEO_CODECS)})")
+    for name, low, high in (("dedup_threshold", 0, 255), ("window", 1, 64)):
+        value = spec.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high):
+            errors.append(f"'sequence.{name}' must be an integer between {low} and {high}")
+    fps = spec.get("fps")
+    if fps is not None and (isinstance(fps, bool) or not isinstance(fps, (int, float)) or fps <= 0):
+        errors.append("'sequence.fps' must be a positive number")
+
+    if errors:
+        return {"valid": False, "errors": errors}
+
+    return {"valid": True, "data": input_data}
+
 def health_check() -> Dict[str, Any]:
-    """Health check endpoint"""
+    """Health check endpoint.
+
+    Answers from the snapshots kept by the pool's supervisor (see
+    ComfyInstance.probe) without calling ComfyUI.
+    """
     try:
-        comfyui_running = comfyui_process is not None and comfyui_process.poll() is None
-        
-        comfyui_api_accessible = False
-        try:
-            with urllib.request.urlopen(f"http://{COMFYUI_HOST}/system_stats") as response:
-                if response.status == 200:
-                    comfyui_api_accessible = True
-        except:
-            pass
+        instances = [instance.status() for instance in comfy_pool.instances]
+        # Le worker est sain tant qu'au moins une instance peut prendre des prompts
+        comfyui_running = any(status["running"] for status in instances)
+        comfyui_api_accessible = any(status["health"]["api_accessible"] for status in instances)
         
-        workflow_exists = os.path.exists(WORKFLOW_PATH)
+        workflow_exists = os.path.exists(workflow_registry.paths[workflow_registry.default])
         network_storage_accessible = os.path.exists(NETWORK_STORAGE_PATH)
         
-        is_healthy = comfyui_running and comfyui_api_accessible and workflow_exists
+        # Prêt = modèles chargés, pas seulement l'API HTTP qui répond
+        is_healthy = comfyui_running and comfyui_api_accessible and workflow_exists and (models_loaded.is_set() or not WARMUP_ENABLED)
         
         return {
             "status": "healthy" if is_healthy else "unhealthy",
             "details": {
                 "comfyui_running": comfyui_running,
                 "comfyui_api_accessible": comfyui_api_accessible,
+                "models_loaded": models_loaded.is_set(),
+                "boot_timings": BOOT_TIMINGS,
                 "workflow_exists": workflow_exists,
-                "network_storage_accessible": network_storage_accessible
-            }
+                "network_storage_accessible": network_storage_accessible,
+                "comfyui_ws_connected": any(status["ws_connected"] for status in instances),
+                "comfyui_ws_reconnects": sum(status["ws_reconnects"] for status in instances),
+                "comfyui_queue_remaining": sum(status["queue_remaining"] or 0 for status in instances),
+                "comfyui_restarting": sum(1 for status in instances if status["restarting"]),
+                "supervisor_running": comfy_pool.supervisor_running(),
+                "admission": admission.snapshot(),
+                "comfyui_instances": instances
+            },
+            "metrics": job_metrics.snapshot()
         }
     except Exception as e:
         return {
@@ -290,8 +2535,293 @@ def health_check() -> Dict[str, Any]:
             "error": str(e)
         }
 
-def handler(job):
-    """Main handler for RunPod Serverless jobs (faceswap via ComfyUI)."""
+def lookup_result_cache(template: CompiledWorkflow, image1_path: str, image2_path: str,
+                        input_data: Dict[str, Any]) -> tuple:
+    """Return (cache_key, cached_result) for a pair; both None when caching is off."""
+    if not (RESULT_CACHE_ENABLED and input_data.get("use_cache", True)):
+        return None, None
+    try:
+        image_hashes = {"image1": file_sha256(image1_path), "image2": file_sha256(image2_path)}
+        preprocess = (input_preprocessor.signature(template, quality_tier(input_data)["max_side"])
+                      if preprocessing_enabled(input_data) else "off")
+        cache_key = result_cache_key(image_hashes, template, input_data.get("params"),
+                                     parse_output_options(input_data), preprocess, input_data.get("quality"))
+    except OSError as e:
+        print(f"Result cache disabled for this job: {str(e)}", file=sys.stderr)
+        return None, None
+    cached = result_cache.get(cache_key)
+    return cache_key, (json.loads(cached) if cached is not None else None)
+
+def submit_or_error(workflow: Dict[str, Any], affinity: Optional[tuple] = None) -> tuple:
+    """submit_prompt() with the handler's error reporting: (instance, prompt_id, events, error)."""
+    try:
+        try:
+            instance, prompt_id, events = submit_prompt(workflow, affinity)
+            print(f"Prompt sent successfully to {instance.name}, ID: {prompt_id}", file=sys.stderr)
+            sys.stderr.flush()
+            return instance, prompt_id, events, None
+        except ComfyHTTPError as http_err:
+            # Capturer plus de détails sur l'erreur HTTP
+            error_body = http_err.body
+            print(f"HTTP Error {http_err.code}: {http_err.reason}", file=sys.stderr)
+            print(f"Error details: {error_body}", file=sys.stderr)
+            sys.stderr.flush()
+            return None, None, None, {"status": "error", "error": f"HTTP Error {http_err.code}: {http_err.reason}", "details": error_body}
+    except Exception as e:
+        print(f"Exception sending prompt: {str(e)}", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+        sys.stderr.flush()
+        return None, None, None, {"status": "error", "error": f"Error sending prompt to ComfyUI: {str(e)}"}
+
+def iter_outputs(instance: ComfyInstance, prompt_id: str, events: "queue.Queue[Dict[str, Any]]",
+                 workflow: Dict[str, Any], node_id: str, stream: bool, transport: str, trace: JobTrace,
+                 deadline: JobDeadline, output: Dict[str, Any]):
+    """Wait for a submitted prompt and collect its output images.
+
+    Generator: in streaming mode it yields progress events and one "image"
+    event per output image (images are not kept); otherwise it yields
+    nothing. Returns (output_entries, image_count), entries as built by
+    deliver_outputs() for the `output` options. Unregisters prompt_id.
+    Queue wait, execution, per-node, fetch, transcode and encode times go to
+    `trace`. With an in-memory transport images arrive as binary WebSocket
+    frames; otherwise they are downloaded through /view. With an in-memory
+    transport, a prompt that completes without sending any frame is an error
+    (RuntimeError): frames are not replayed after a WebSocket reconnect.
+    Raises DeadlineExceeded, JobCancelled, ComfyExecutionError or RuntimeError on
+    failure. When the deadline passes, the job is cancelled or the generator
+    is closed early, the prompt is cancelled in ComfyUI; the report is
+    attached to the exception as `cleanup`.
+    """
+    output_images = []
+    images_sent = 0
+    try:
+        # Wait for execution via the shared WebSocket
+        execution_start = time.time()
+        for message in iter_prompt_events(events, prompt_id, deadline.remaining(), deadline.cancelled):
+            trace.on_event(message)
+            data = message["data"]
+            if message["type"] == "faceswap_image" and data.get("node") == node_id:
+                # Image reçue directement en frame binaire: ni disque, ni /history, ni /view
+                fmt = data.get("format", "png")
+                entries = deliver_outputs([(data["image"], fmt)], output, trace,
+                                          encoded=fmt == output["format"])
+            # Les images sont récupérées dès l'event "executed" du node de sortie
+            elif message["type"] == "executed" and data.get("node") == node_id:
+                try:
+                    fetched = fetch_images(instance.client, (data.get("output") or {}).get("images", []), trace)
+                    entries = deliver_outputs(fetched, output, trace)
+                except Exception as e:
+                    raise RuntimeError(f"Error retrieving images: {str(e)}")
+            else:
+                if stream:
+                    event = progress_event(message, workflow)
+                    if event is not None:
+                        yield event
+                continue
+            for entry in entries:
+                if stream:
+                    yield output_event(node_id, images_sent, entry)
+                else:
+                    output_images.append(entry)
+                images_sent += 1
+        trace.finished()
+        print(f"Execution completed in {time.time() - execution_start:.2f} seconds", file=sys.stderr)
+        sys.stderr.flush()
+        instance.warm.set()  # Un job réussi a forcément chargé tous les modèles
+        models_loaded.set()
+    except (DeadlineExceeded, JobCancelled) as e:
+        # Personne ne lira ce résultat: libérer la file / le GPU tout de suite
+        e.cleanup = cancel_prompt(instance, prompt_id)
+        raise
+    except GeneratorExit:
+        cancel_prompt(instance, prompt_id)
+        raise
+    finally:
+        instance.events.unregister(prompt_id)
+
+    # Fallback: pas d'event "executed" reçu (ex: reconnexion WebSocket), passer par /history
+    if images_sent == 0 and transport == "file":
+        try:
+            with trace.stage("history"):
+                history = instance.client.get_json(f"/history/{prompt_id}")[prompt_id]
+        except Exception as e:
+            raise RuntimeError(f"Error retrieving history: {str(e)}")
+
+        try:
+            node_output = history['outputs'].get(node_id, {})
+            entries = deliver_outputs(fetch_images(instance.client, node_output.get('images', []), trace), output, trace)
+        except Exception as e:
+            raise RuntimeError(f"Error retrieving images: {str(e)}")
+        for entry in entries:
+            if stream:
+                yield output_event(node_id, images_sent, entry)
+            else:
+                output_images.append(entry)
+            images_sent += 1
+    if images_sent == 0 and transport != "file":
+        # Frames binaires non rejouées après une reconnexion WebSocket: pas de /history possible
+        raise RuntimeError(f"No image received from node {node_id} (result lost, e.g. WebSocket reconnect)")
+    print(f"{images_sent} image(s) retrieved from node {node_id}", file=sys.stderr)
+    sys.stderr.flush()
+    return output_images, images_sent
+
+def collect_node_images(instance: ComfyInstance, prompt_id: str, events: "queue.Queue[Dict[str, Any]]",
+                        node_ids: List[str], deadline: JobDeadline) -> Dict[str, bytes]:
+    """Wait for a submitted prompt and return the first image of each of `node_ids`.
+
+    Images arrive as binary WebSocket frames or are downloaded through /view
+    (the files are then deleted), as in iter_outputs. Unregisters prompt_id;
+    the prompt is cancelled in ComfyUI on timeout or job cancellation.
+    Raises like iter_outputs, and RuntimeError if a node sent no image.
+    """
+    collected: Dict[str, bytes] = {}
+    try:
+        for message in iter_prompt_events(events, prompt_id, deadline.remaining(), deadline.cancelled):
+            data = message["data"]
+            node_id = data.get("node")
+            if node_id not in node_ids or node_id in collected:
+                continue
+            if message["type"] == "faceswap_image":
+                collected[node_id] = data["image"]
+            elif message["type"] == "executed":
+                images = (data.get("output") or {}).get("images", [])
+                if images:
+                    collected[node_id] = instance.client.download_many(images[:1])[0]
+                    instance.remove_outputs({node_id: {"images": images}})
+    except (DeadlineExceeded, JobCancelled):
+        cancel_prompt(instance, prompt_id)
+        raise
+    finally:
+        instance.events.unregister(prompt_id)
+    missing = [node_id for node_id in node_ids if node_id not in collected]
+    if missing:
+        raise RuntimeError(f"No image received from node(s) {missing}")
+    return collected
+
+def source_artifacts(template: CompiledWorkflow, image1_path: str, transport: str,
+                     input_data: Dict[str, Any], deadline: JobDeadline) -> Dict[str, str]:
+    """Precomputed source subgraph outputs for image1, as {frontier node id: PNG path}.
+
+    The part of the workflow that depends on image1 alone (face detection and
+    crop, see CompiledWorkflow.source_frontier) runs once per source identity:
+    its outputs are kept in source_cache under the content hash of the
+    submitted image1 and the fingerprint of that subgraph, and passed to
+    instantiate() so later jobs with the same face skip it. Empty (the job
+    runs the full graph) when disabled, when the workflow cannot be split or
+    when the precompute fails, HTTP timeouts included. Only the end of the
+    job itself (deadline passed or cancelled) propagates, as DeadlineExceeded
+    or JobCancelled: the full workflow must not be submitted either.
+    """
+    tier = input_data.get("quality")
+    if not (SOURCE_CACHE_ENABLED and input_data.get("source_cache", True)):
+        return {}
+    frontier = template.source_frontier(tier)
+    if not frontier:
+        return {}
+    try:
+        identity = f"{file_sha256(image1_path)}:{template.source_fingerprint(tier)}"
+        keys = {node_id: hashlib.sha256(f"{identity}:{node_id}".encode("utf-8")).hexdigest() for node_id in frontier}
+        paths = {node_id: source_cache.get_path(key) for node_id, key in keys.items()}
+        if all(paths.values()):
+            return paths
+
+        # Précalcul: seul le sous-graphe de la source tourne, un node de sortie PNG par frontière
+        if transport == "file":
+            output_node = {"class_type": "PreviewImage"}
+        else:
+            output_node = {"class_type": SEND_IMAGE_WS_CLASS, "format": "PNG", "quality": 95, "max_dim": 0}
+        images, acquired = prepare_image_inputs({"image1": image1_path}, transport)
+        try:
+            prompt = template.precompute_graph(images["image1"], output_node, tier)
+            instance, prompt_id, events = submit_prompt(prompt, (template.name, image1_path))
+            collected = collect_node_images(instance, prompt_id, events,
+                                            [f"{node_id}_artifact" for node_id in frontier], deadline)
+        finally:
+            release_image_inputs(acquired)
+        for node_id, key in keys.items():
+            source_cache.put(key, collected[f"{node_id}_artifact"])
+            paths[node_id] = source_cache.path_for(key)
+        if not all(map(os.path.exists, paths.values())):
+            return {}  # Artefact plus gros que le cache: pas de réutilisation possible
+        print(f"Source artifacts computed for {image1_path} on {instance.name}: {sorted(paths)}", file=sys.stderr)
+        sys.stderr.flush()
+        return paths
+    except (DeadlineExceeded, JobCancelled):
+        raise
+    except Exception as e:
+        print(f"Source precompute skipped, running the full workflow: {str(e)}", file=sys.stderr)
+        sys.stderr.flush()
+        return {}
+
+def execution_error(e: Exception, instance: ComfyInstance) -> Dict[str, Any]:
+    """Error response for a failure while waiting for / collecting a prompt on `instance`."""
+    if isinstance(e, DeadlineExceeded):
+        return {"status": "error", "error": "Timeout during workflow execution", "instance": instance.name,
+                "cleanup": getattr(e, "cleanup", None), "comfyui_log_tail": instance.logs.tail(HEALTH_LOG_LINES)}
+    if isinstance(e, JobCancelled):
+        return {"status": "error", "error": "Job cancelled", "instance": instance.name,
+                "cleanup": getattr(e, "cleanup", None)}
+    if isinstance(e, ComfyExecutionError):
+        return {"status": "error", "error": str(e), "details": e.details, "instance": instance.name,
+                "comfyui_log_tail": instance.logs.tail(HEALTH_LOG_LINES)}
+    return {"status": "error", "error": str(e)}
+
+def success_result(prompt_id: str, node_id: str, output_images: List[Any], images_sent: int,
+                   stream: bool, cache_key: Optional[str], output: Dict[str, Any]) -> Dict[str, Any]:
+    """Build a success response and store it in the result cache.
+
+    Entries go to "output_images" (base64) or "output_refs" (reference mode).
+    """
+    result = {
+        "status": "success",
+        "prompt_id": prompt_id,
+        "output_node": node_id,
+        "message": f"{images_sent} image(s) generated by node {node_id}."
+    }
+    if stream:
+        # Images déjà envoyées une par une, pas de copie dans la réponse finale
+        result["images_streamed"] = images_sent
+    else:
+        result["output_refs" if output["mode"] == "reference" else "output_images"] = output_images
+        result["output_format"] = output["format"]
+        if cache_key and output_images:
+            result_cache.put(cache_key, json.dumps(result).encode("utf-8"))
+    return result
+
+def cache_info(hit: bool, cache_key: Optional[str]) -> Dict[str, Any]:
+    return {"hit": hit, "key": cache_key, **result_cache.stats()}
+
+def job_timeout(job) -> float:
+    """The job's time budget: its "timeout" input in seconds, else SEQUENCE_TIMEOUT
+    for a sequence job and EXECUTION_TIMEOUT otherwise."""
+    job_input = job.get("input") or {}
+    timeout = job_input.get("timeout")
+    if isinstance(timeout, (int, float)) and not isinstance(timeout, bool) and timeout > 0:
+        return float(timeout)
+    if "sequence" in job_input:
+        return float(SEQUENCE_TIMEOUT)
+    return float(EXECUTION_TIMEOUT)
+
+def iter_job(job, stream: bool = False, cancelled: Optional[threading.Event] = None):
+    """Process one RunPod job (faceswap via ComfyUI) as a generator.
+
+    With `stream=True` it yields progress events and each output image as
+    soon as its node has executed, without keeping them in memory; otherwise
+    it yields nothing. In both modes the final response is the generator's
+    return value (see run_job and stream_handler), with a "timings" entry.
+    The whole job shares one deadline; setting `cancelled` aborts it.
+    """
+    trace = JobTrace()
+    deadline = JobDeadline(job_timeout(job), cancelled)
+    result = yield from _iter_job(job, stream, trace, deadline)
+    if isinstance(result, dict) and not job.get("health_check", False):
+        result["timings"] = trace.as_dict()
+        job_metrics.record(trace, result.get("status", "error"))
+        if result.get("status") == "success":
+            admission.record(admission_key(job.get("input", {})), trace)
+    return result
+
+def _iter_job(job, stream: bool, trace: JobTrace, deadline: JobDeadline):
     print(f"Handler called with job: {job}", file=sys.stderr)
     sys.stderr.flush()
 
@@ -302,7 +2832,8 @@ def handler(job):
 
         # Input validation
         job_input = job.get("input", {})
-        input_validation = validate_input(job_input)
+        with trace.stage("validation"):
+            input_validation = validate_input(job_input)
         if not input_validation["valid"]:
             return {
                 "status": "error",
@@ -311,194 +2842,757 @@ def handler(job):
             }
         input_data = input_validation["data"]
 
+        # Workflow compilé (pas de lecture de fichier ni de parcours du graphe par job)
+        try:
+            with trace.stage("workflow"):
+                template = workflow_registry.get(input_data.get("workflow"))
+        except Exception as e:
+            return {"status": "error", "error": f"Error loading workflow: {str(e)}"}
+
+        if "sequence" in input_data:
+            return (yield from iter_sequence(input_data, template, stream, trace, deadline,
+                                             str(job.get("id") or uuid.uuid4())))
+        if "items" in input_data:
+            return (yield from iter_batch(input_data, template, stream, trace, deadline))
+
+        # Convertir les chemins relatifs en chemins absolus
+        image1_path = os.path.abspath(input_data["image1_path"])
+        image2_path = os.path.abspath(input_data["image2_path"])
+
+        print(f"Processing faceswap with image1: {image1_path}, image2: {image2_path} (workflow '{template.name}')", file=sys.stderr)
+        sys.stderr.flush()
+
+        try:
+            template.validate_params(input_data.get("params"))
+        except ValueError as e:
+            return {"status": "error", "error": str(e), "details": "Invalid workflow parameters"}
+        output = parse_output_options(input_data)
+
+        # Cache de résultats: un hit ne touche pas du tout ComfyUI
+        with trace.stage("cache_lookup"):
+            cache_key, cached = lookup_result_cache(template, image1_path, image2_path, input_data)
+        if cached is not None:
+            cached["cache"] = cache_info(True, cache_key)
+            trace.bytes_out += sum(map(output_entry_size, cached.get("output_images") or cached.get("output_refs") or []))
+            print(f"Result cache hit: {cache_key}", file=sys.stderr)
+            sys.stderr.flush()
+            if stream:
+                for index, entry in enumerate(pop_cached_entries(cached)):
+                    yield output_event(cached.get("output_node"), index, entry)
+            return cached
+
         # Start ComfyUI
-        if not start_comfyui():
+        with trace.stage("comfyui_boot"):
+            comfyui_ready = start_comfyui()
+        if not comfyui_ready:
             return {
                 "status": "error",
                 "error": "Failed to start ComfyUI",
                 "details": "ComfyUI server failed to start or respond within the timeout period"
             }
+        if deadline.expired():
+            return deadline.error()
+        # Contrôle d'admission: pas de prompt qui finirait après la deadline
+        rejection = admission.check(admission_key(input_data), 1, deadline)
+        if rejection:
+            return rejection
 
-        # Charger le workflow
+        # Update workflow with image inputs and request parameters
+        transport = image_transport()
         try:
-            with open(WORKFLOW_PATH, "r", encoding="utf-8") as f:
-                workflow = json.load(f)
-        except Exception as e:
-            return {"status": "error", "error": f"Error loading workflow: {str(e)}"}
+            # Photos clientes: orientation EXIF, métadonnées et résolution normalisées avant ComfyUI
+            with trace.stage("preprocess"):
+                paths = preprocess_inputs({"image1": image1_path, "image2": image2_path}, template, input_data)
+        except OSError as e:
+            return {"status": "error", "error": f"Error reading images: {str(e)}"}
+        # Détection + crop du visage source: calculés une fois par identité puis réutilisés
+        try:
+            with trace.stage("source_cache"):
+                paths.update(source_artifacts(template, paths["image1"], transport, input_data, deadline))
+            deadline.check()
+        except (DeadlineExceeded, JobCancelled):
+            return deadline.error()
+        with trace.stage("input_prep"):
+            images, acquired = prepare_image_inputs(paths, transport)
+        try:
+            with trace.stage("workflow"):
+                workflow = template.instantiate(images, input_data.get("params"), output_node_spec(transport, output),
+                                                input_data.get("quality"))
 
-        # Convertir les chemins relatifs en chemins absolus
-        image1_path = input_data["image1_path"]
-        image2_path = input_data["image2_path"]
-        
-        # Vérifier si les chemins sont absolus, sinon les convertir
-        if not os.path.isabs(image1_path):
-            image1_path = os.path.abspath(image1_path)
-        if not os.path.isabs(image2_path):
-            image2_path = os.path.abspath(image2_path)
+            # Send workflow to ComfyUI
+            with trace.stage("submit"):
+                instance, prompt_id, events, error = submit_or_error(workflow, (template.name, image1_path))
+            if error:
+                return error
+            trace.submitted()
 
-        print(f"Processing faceswap with image1: {image1_path}, image2: {image2_path}", file=sys.stderr)
-        sys.stderr.flush()
+            if stream:
+                yield {"type": "queued", "prompt_id": prompt_id, "instance": instance.name,
+                       "position": queue_position(instance, prompt_id)}
 
-        # Vérifier les nodes dans le workflow
-        print(f"Workflow contains these nodes: {list(workflow.keys())}", file=sys.stderr)
-        sys.stderr.flush()
-        
-        # Update workflow with image paths
-        # Détection des nodes d'entrée d'image - chercher des noms de clef génériques
-        image_nodes_updated = False
-        
-        # Chercher les nodes LoadImage dans le workflow
-        for node_id, node in workflow.items():
-            if node.get("class_type") == "LoadImage":
-                print(f"Found LoadImage node {node_id}: {node}", file=sys.stderr)
-                if not image_nodes_updated:
-                    # Premier node = image1, second = image2
-                    print(f"Setting node {node_id} to use image1: {image1_path}", file=sys.stderr)
-                    node["inputs"]["image"] = image1_path
-                    image_nodes_updated = True
-                else:
-                    print(f"Setting node {node_id} to use image2: {image2_path}", file=sys.stderr)
-                    node["inputs"]["image"] = image2_path
-                    break
+            node_id = template.output_node  # SaveImage node
+            try:
+                output_images, images_sent = yield from iter_outputs(instance, prompt_id, events, workflow, node_id,
+                                                                     stream, transport, trace, deadline, output)
+            except Exception as e:
+                return execution_error(e, instance)
+        finally:
+            release_image_inputs(acquired)
 
-        # Fallback - utiliser les IDs spécifiés si les LoadImage n'ont pas été trouvés
-        if not image_nodes_updated:
-            if "240" in workflow:
-                print(f"Using fallback node 240 for image1", file=sys.stderr)
-                workflow["240"]["inputs"]["image"] = image1_path
-            if "431" in workflow:
-                print(f"Using fallback node 431 for image2", file=sys.stderr)
-                workflow["431"]["inputs"]["image"] = image2_path
-        
+        result = success_result(prompt_id, node_id, output_images, images_sent, stream, cache_key, output)
+        if RESULT_CACHE_ENABLED and input_data.get("use_cache", True):
+            result["cache"] = cache_info(False, cache_key)
+        return result
+
+    except Exception as e:
+        print(f"Unhandled error: {str(e)}", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
         sys.stderr.flush()
+        return {
+            "status": "error",
+            "error": str(e),
+            "traceback": traceback.format_exc()
+        }
 
-        # Generate unique client_id
-        client_id = str(uuid.uuid4())
+def iter_batch(input_data: Dict[str, Any], template: CompiledWorkflow, stream: bool, trace: JobTrace,
+               deadline: JobDeadline):
+    """Fan a batch of (image1, image2) pairs out to ComfyUI in one job.
 
-        # Send workflow to ComfyUI
-        prompt = {"prompt": workflow, "client_id": client_id}
-        data = json.dumps(prompt).encode('utf-8')
-        
-        # Debug: afficher le prompt envoyé (format condensé pour éviter trop de logs)
-        debug_prompt = json.dumps(prompt, indent=None)
-        print(f"Sending prompt to ComfyUI: {debug_prompt[:200]}... (truncated)", file=sys.stderr)
-        sys.stderr.flush()
+    Every prompt is queued up front so ComfyUI runs them back-to-back, then
+    results are collected per prompt_id in queue order. Pairs are submitted
+    grouped by source image (then target) with source affinity, so the pool
+    keeps them on the instance whose node-output cache already holds the
+    source-face loading/detection, spilling to others only when it is busier.
+    Each item gets its own status: one failure does not fail the batch.
+    Items still queued when the deadline passes (or the job is cancelled)
+    are removed from ComfyUI instead of being left to run.
+    """
+    items = [
+        {"index": index, "image1_path": os.path.abspath(item["image1_path"]),
+         "image2_path": os.path.abspath(item["image2_path"])}
+        for index, item in enumerate(input_data["items"])
+    ]
+    results: Dict[int, Dict[str, Any]] = {}
+    pending = []
+    node_id = template.output_node
 
-        try:
-            req = urllib.request.Request(
-                f"http://{COMFYUI_HOST}/prompt", data=data,
-                headers={"Content-Type": "application/json"}
-            )
+    print(f"Processing faceswap batch of {len(items)} pair(s) (workflow '{template.name}')", file=sys.stderr)
+    sys.stderr.flush()
+
+    try:
+        template.validate_params(input_data.get("params"))
+    except ValueError as e:
+        return {"status": "error", "error": str(e), "details": "Invalid workflow parameters"}
+
+    output = parse_output_options(input_data)
+    comfyui_ready = None
+    transport = "file"
+    acquired: List[str] = []
+    try:
+        for item in sorted(items, key=lambda it: (it["image1_path"], it["image2_path"])):
+            index = item["index"]
+            missing = [path for path in (item["image1_path"], item["image2_path"]) if not os.path.exists(path)]
+            if missing:
+                results[index] = {"status": "error", "error": f"Image doesn't exist at path: {missing[0]}"}
+                continue
+            with trace.stage("cache_lookup"):
+                cache_key, cached = lookup_result_cache(template, item["image1_path"], item["image2_path"], input_data)
+            if cached is not None:
+                cached["cache"] = cache_info(True, cache_key)
+                trace.bytes_out += sum(map(output_entry_size, cached.get("output_images") or cached.get("output_refs") or []))
+                results[index] = cached
+                continue
+            if comfyui_ready is None:
+                with trace.stage("comfyui_boot"):
+                    comfyui_ready = start_comfyui()
+                if comfyui_ready:
+                    transport = image_transport()
+                    # Admission pour tous les items restants (ceux déjà en cache n'en ont pas besoin)
+                    rejection = admission.check(admission_key(input_data), len(items) - len(results), deadline)
+                    if rejection:
+                        return rejection
+            if not comfyui_ready:
+                results[index] = {"status": "error", "error": "Failed to start ComfyUI"}
+                continue
+            if deadline.expired():
+                results[index] = deadline.error()
+                continue
             try:
-                with urllib.request.urlopen(req) as resp:
-                    resp_content = resp.read()
-                    resp_json = json.loads(resp_content)
-                prompt_id = resp_json['prompt_id']
-                print(f"Prompt sent successfully, ID: {prompt_id}", file=sys.stderr)
-                sys.stderr.flush()
-            except urllib.error.HTTPError as http_err:
-                # Capturer plus de détails sur l'erreur HTTP
-                error_body = http_err.read().decode('utf-8')
-                print(f"HTTP Error {http_err.code}: {http_err.reason}", file=sys.stderr)
-                print(f"Error details: {error_body}", file=sys.stderr)
-                sys.stderr.flush()
-                return {"status": "error", "error": f"HTTP Error {http_err.code}: {http_err.reason}", "details": error_body}
-        except Exception as e:
-            print(f"Exception sending prompt: {str(e)}", file=sys.stderr)
-            print(traceback.format_exc(), file=sys.stderr)
-            sys.stderr.flush()
-            return {"status": "error", "error": f"Error sending prompt to ComfyUI: {str(e)}"}
+                with trace.stage("preprocess"):
+                    paths = preprocess_inputs({"image1": item["image1_path"], "image2": item["image2_path"]},
+                                              template, input_data)
+                with trace.stage("source_cache"):
+                    paths.update(source_artifacts(template, paths["image1"], transport, input_data, deadline))
+                deadline.check()
+                with trace.stage("input_prep"):
+                    images, item_acquired = prepare_image_inputs(paths, transport)
+            except (DeadlineExceeded, JobCancelled):
+                results[index] = deadline.error()
+                continue
+            except OSError as e:
+                results[index] = {"status": "error", "error": f"Error reading images: {str(e)}"}
+                continue
+            acquired.extend(item_acquired)
+            with trace.stage("workflow"):
+                workflow = template.instantiate(images, input_data.get("params"), output_node_spec(transport, output),
+                                                input_data.get("quality"))
+            with trace.stage("submit"):
+                instance, prompt_id, events, error = submit_or_error(workflow, (template.name, item["image1_path"]))
+            if error:
+                results[index] = error
+                continue
+            pending.append((index, instance, prompt_id, events, workflow, cache_key))
+            if stream:
+                yield {"type": "queued", "item": index, "prompt_id": prompt_id, "instance": instance.name}
+
+        # Chaque instance exécute sa file dans l'ordre: on collecte dans l'ordre de soumission
+        while pending:
+            index, instance, prompt_id, events, workflow, cache_key = pending.pop(0)
+            # Les prompts s'enchaînent: l'attente en file d'un item commence à la fin du précédent
+            trace.submitted()
+            try:
+                outputs = iter_outputs(instance, prompt_id, events, workflow, node_id, stream, transport, trace,
+                                       deadline, output)
+                try:
+                    while True:
+                        try:
+                            event = next(outputs)
+                        except StopIteration as stop:
+                            output_images, images_sent = stop.value
+                            break
+                        yield {**event, "item": index}
+                finally:
+                    outputs.close()
+                results[index] = success_result(prompt_id, node_id, output_images, images_sent, stream, cache_key,
+                                                output)
+            except Exception as e:
+                results[index] = execution_error(e, instance)
+            if stream:
+                yield {"type": "item_done", "item": index, "status": results[index]["status"]}
+    finally:
+        # Sortie anticipée (exception, stream abandonné): les prompts non collectés ne servent plus
+        for _, instance, prompt_id, *_ in pending:
+            instance.events.unregister(prompt_id)
+            cancel_prompt(instance, prompt_id)
+        release_image_inputs(acquired)
+
+    for index, item in enumerate(items):
+        results[index] = {"index": index, "image1_path": item["image1_path"],
+                          "image2_path": item["image2_path"], **results[index]}
+    succeeded = sum(1 for result in results.values() if result["status"] == "success")
+    return {
+        "status": "success" if succeeded == len(items) else ("partial" if succeeded else "error"),
+        "items": [results[index] for index in range(len(items))],
+        "message": f"{succeeded}/{len(items)} pair(s) processed successfully.",
+        "cache": result_cache.stats()
+    }
+
+def _natural_key(name: str) -> List[Any]:
+    """Sort key so "frame_10" comes after "frame_9"."""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+def _is_frame_name(name: str) -> bool:
+    return name.lower().endswith(FRAME_EXTENSIONS) and not os.path.basename(name).startswith(".")
+
+def probe_video(path: str) -> tuple:
+    """(width, height, fps) of a video's first stream, as displayed (rotation applied)."""
+    output = subprocess.run(
+        [FFPROBE_PATH, "-v", "error", "-select_streams", "v:0", "-show_entries",
+         "stream=width,height,r_frame_rate:stream_tags=rotate:stream_side_data=rotation", "-of", "json", path],
+        capture_output=True, check=True, timeout=60).stdout
+    stream = json.loads(output)["streams"][0]
+    width, height = int(stream["width"]), int(stream["height"])
+    rotation = stream.get("tags", {}).get("rotate") or next(
+        (data.get("rotation") for data in stream.get("side_data_list", []) if "rotation" in data), 0)
+    if abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+    numerator, _, denominator = stream.get("r_frame_rate", "0/1").partition("/")
+    fps = float(numerator) / float(denominator or 1) if float(denominator or 1) else 0.0
+    return width, height, fps or SEQUENCE_FPS
 
-        # Wait for execution via WebSocket
+def iter_sequence_frames(path: str, workdir: str):
+    """Yield (frame_path, owned) for each frame of a sequence, in order.
+
+    `path` is a directory of images, a zip/tar archive of images or a video
+    decoded with ffmpeg. Archive and video frames are written one at a time
+    to `workdir` (`owned`: the caller deletes them once used), so only the
+    frames in flight are ever on disk.
+    """
+    if os.path.isdir(path):
+        for name in sorted(filter(_is_frame_name, os.listdir(path)), key=_natural_key):
+            yield os.path.join(path, name), False
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            members = [info for info in archive.infolist() if not info.is_dir() and _is_frame_name(info.filename)]
+            for index, info in enumerate(sorted(members, key=lambda info: _natural_key(info.filename))):
+                frame_path = os.path.join(workdir, f"frame_{index:06d}{os.path.splitext(info.filename)[1].lower()}")
+                with archive.open(info) as src, open(frame_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                yield frame_path, True
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            members = [info for info in archive.getmembers() if info.isfile() and _is_frame_name(info.name)]
+            for index, info in enumerate(sorted(members, key=lambda info: _natural_key(info.name))):
+                frame_path = os.path.join(workdir, f"frame_{index:06d}{os.path.splitext(info.name)[1].lower()}")
+                with archive.extractfile(info) as src, open(frame_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                yield frame_path, True
+    else:
+        width, height, _ = probe_video(path)
+        frame_size = width * height * 3
+        process = subprocess.Popen([FFMPEG_PATH, "-v", "error", "-i", path, "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
         try:
-            ws = websocket.WebSocket()
-            ws.connect(f"ws://{COMFYUI_HOST}/ws?clientId={client_id}")
-            ws.settimeout(300)  # 5 minutes max
-            execution_start = time.time()
+            index = 0
             while True:
-                try:
-                    out = ws.recv()
-                    if isinstance(out, str):
-                        message = json.loads(out)
-                        if message['type'] == 'executing':
-                            data = message['data']
-                            if data['node'] is None and data['prompt_id'] == prompt_id:
-                                print(f"Execution completed in {time.time() - execution_start:.2f} seconds", file=sys.stderr)
-                                sys.stderr.flush()
-                                break  # Execution completed
-                    if time.time() - execution_start > 300:
-                        return {"status": "error", "error": "Timeout during workflow execution"}
-                except websocket.WebSocketTimeoutException:
-                    return {"status": "error", "error": "Timeout waiting for WebSocket results"}
-            ws.close()
-        except Exception as e:
-            return {"status": "error", "error": f"WebSocket communication error: {str(e)}"}
+                raw = process.stdout.read(frame_size)
+                if len(raw) < frame_size:
+                    break
+                frame_path = os.path.join(workdir, f"frame_{index:06d}.png")
+                Image.frombytes("RGB", (width, height), raw).save(frame_path, compress_level=1)
+                index += 1
+                yield frame_path, True
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+def frame_fingerprint(path: str) -> Image.Image:
+    """64x64 RGB thumbnail of a frame, compared with frame_distance()."""
+    with Image.open(path) as img:
+        img.draft("RGB", (128, 128))
+        return img.convert("RGB").resize((64, 64), Image.Resampling.BOX)
+
+
+def frame_distance(a: Image.Image, b: Image.Image) -> int:
+    """Largest per-pixel, per-channel difference (0-255) between two fingerprints.
+
+    The maximum rather than the mean: a mouth or eye movement touches a few
+    percent of the frame and must not be averaged away.
+    """
+    return max(high for _, high in ImageChops.difference(a, b).getextrema())
+
+
+class FrameDirWriter:
+    """Writes a sequence's output frames as numbered PNGs in a directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.frames = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, data: bytes) -> None:
+        with open(os.path.join(self.path, f"frame_{self.frames:06d}.png"), "wb") as f:
+            f.write(data)
+        self.frames += 1
+
+    def close(self) -> None:
+        pass
+
+
+class VideoWriter:
+    """Pipes a sequence's output frames (PNG) into an ffmpeg encoder as they arrive."""
+
+    def __init__(self, path: str, fps: float):
+        self.path = path
+        self.frames = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        codec = VIDEO_CODECS[os.path.splitext(path)[1].lower()]
+        self.process = subprocess.Popen(
+            [FFMPEG_PATH, "-v", "error", "-y", "-f", "image2pipe", "-framerate", f"{fps:g}", "-c:v", "png", "-i", "-",
+             # Les encodeurs yuv420p exigent des dimensions paires
+             "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-c:v", codec, "-pix_fmt", "yuv420p", path],
+            stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, data: bytes) -> None:
+        self.process.stdin.write(data)
+        self.frames += 1
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        stderr = self.process.stderr.read().decode("utf-8", "replace")
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {self.path}: {stderr[-500:]}")
+
+
+def open_sequence_writer(path: str, fps: float):
+    """VideoWriter for a video extension (see VIDEO_CODECS), else FrameDirWriter."""
+    if os.path.splitext(path)[1].lower() in VIDEO_CODECS:
+        return VideoWriter(path, fps)
+    return FrameDirWriter(path)
+
+def passthrough_frame(path: str) -> bytes:
+    """A frame ComfyUI could not process, re-encoded as PNG so the sequence keeps its length."""
+    with Image.open(path) as img:
+        image = ImageOps.exif_transpose(img).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "PNG", compress_level=4)
+    return out.getvalue()
+
+def iter_sequence(input_data: Dict[str, Any], template: CompiledWorkflow, stream: bool, trace: JobTrace,
+                  deadline: JobDeadline, job_id: str):
+    """Swap image1's face onto every frame of input_data["sequence"]["path"].
 
-        # Get history and image from node 413
+    Each frame is fingerprinted (64x64 thumbnail); a frame no pixel of
+    which differs by more than `dedup_threshold` levels from the last
+    processed frame reuses its output instead of being submitted. The
+    default (SEQUENCE_DEDUP_THRESHOLD) absorbs codec noise but not facial
+    motion; 0 restricts reuse to exact duplicates. Unique frames are
+    submitted with source affinity and kept at most `window` prompts
+    ahead of collection, so ComfyUI's queue stays fed while outputs are
+    written in order by a streaming writer (numbered PNGs or an
+    ffmpeg-encoded video): memory and temporary disk use stay flat
+    whatever the clip length. A frame ComfyUI fails on (e.g. no face
+    detected) is written unchanged, at the resolution it was submitted at
+    (or as the previous output if it could not be read), and counted in
+    "failed_frames".
+    """
+    spec = input_data["sequence"]
+    source_path = os.path.abspath(input_data["image1_path"])
+    sequence_path = os.path.abspath(spec["path"])
+    threshold = spec.get("dedup_threshold", SEQUENCE_DEDUP_THRESHOLD)
+    window = spec.get("window", SEQUENCE_WINDOW)
+    output_path = os.path.abspath(spec.get("output_path") or os.path.join(SEQUENCE_OUTPUT_DIR, job_id))
+    output = {**parse_output_options(input_data), "format": "png", "max_dim": None, "mode": "raw"}
+    node_id = template.output_node
+
+    print(f"Processing faceswap sequence {sequence_path} -> {output_path} (workflow '{template.name}')", file=sys.stderr)
+    sys.stderr.flush()
+
+    try:
+        template.validate_params(input_data.get("params"))
+    except ValueError as e:
+        return {"status": "error", "error": str(e), "details": "Invalid workflow parameters"}
+    fps = spec.get("fps")
+    if fps is None:
+        fps = SEQUENCE_FPS
+        if os.path.isfile(sequence_path) and not zipfile.is_zipfile(sequence_path) and not tarfile.is_tarfile(sequence_path):
+            try:
+                fps = probe_video(sequence_path)[2]
+            except Exception as e:
+                return {"status": "error", "error": f"Error reading video: {str(e)}"}
+
+    with trace.stage("comfyui_boot"):
+        comfyui_ready = start_comfyui()
+    if not comfyui_ready:
+        return {"status": "error", "error": "Failed to start ComfyUI"}
+    transport = image_transport()
+    rejection = admission.check(admission_key(input_data), 1, deadline)
+    if rejection:
+        return rejection
+
+    counts = {"frames": 0, "unique_frames": 0, "reused_frames": 0, "failed_frames": 0}
+    pending: "deque[Dict[str, Any]]" = deque()
+    last_fingerprint: Optional[Image.Image] = None
+    last_output: Optional[bytes] = None
+    writer = None
+    instance = None
+
+    def submit(index: int, frame_path: str, owned: bool) -> Dict[str, Any]:
+        run = {"index": index, "frame": frame_path, "owned": owned, "repeat": 0, "acquired": [], "prompt_id": None}
         try:
-            with urllib.request.urlopen(f"http://{COMFYUI_HOST}/history/{prompt_id}") as response:
-                history = json.loads(response.read())
-            history = history[prompt_id]
-        except Exception as e:
-            return {"status": "error", "error": f"Error retrieving history: {str(e)}"}
+            with trace.stage("preprocess"):
+                paths = preprocess_inputs({"image1": source_path, "image2": frame_path}, template, input_data)
+            run["target"] = paths["image2"]  # Image réellement soumise: même taille que les sorties
+            with trace.stage("source_cache"):
+                paths.update(source_artifacts(template, paths["image1"], transport, input_data, deadline))
+            deadline.check()
+            with trace.stage("input_prep"):
+                images, run["acquired"] = prepare_image_inputs(paths, transport)
+        except (DeadlineExceeded, JobCancelled):
+            raise
+        except OSError as e:
+            run["error"] = f"Error reading images: {str(e)}"
+            return run
+        with trace.stage("workflow"):
+            workflow = template.instantiate(images, input_data.get("params"), output_node_spec(transport, output),
+                                            input_data.get("quality"))
+        with trace.stage("submit"):
+            run["instance"], run["prompt_id"], run["events"], error = submit_or_error(workflow, (template.name, source_path))
+        run["workflow"] = workflow
+        if error:
+            run["error"] = error["error"]
+        return run
+
+    def emit(data: bytes, frames: int) -> None:
+        for _ in range(frames):
+            writer.write(data)
+
+    def fallback_frame(run: Dict[str, Any]) -> bytes:
+        # Jamais la frame brute: sa taille peut différer des sorties (résolution plafonnée par le preprocessing)
+        if run.get("target"):
+            try:
+                return passthrough_frame(run["target"])
+            except OSError:
+                pass
+        if last_output is None:
+            raise RuntimeError(f"Frame {run['index']} could not be processed nor passed through: {run.get('error')}")
+        return last_output
 
-        # Get generated images
-        output_images = []
-        node_id = "413"  # SaveImage node
+    def collect(run: Dict[str, Any]):
+        nonlocal last_output, instance
         try:
-            node_output = history['outputs'].get(node_id, {})
-            if 'images' in node_output:
-                for image in node_output['images']:
-                    params = urllib.parse.urlencode({
-                        "filename": image['filename'],
-                        "subfolder": image['subfolder'],
-                        "type": image['type']
-                    })
-                    with urllib.request.urlopen(f"http://{COMFYUI_HOST}/view?{params}") as img_resp:
-                        img_bytes = img_resp.read()
-                        img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-                        output_images.append(img_b64)
-                print(f"{len(output_images)} image(s) retrieved from node {node_id}", file=sys.stderr)
+            data = None
+            if run["prompt_id"] is not None:
+                instance = run["instance"]
+                trace.submitted()
+                try:
+                    entries, _ = yield from iter_outputs(instance, run["prompt_id"], run["events"], run["workflow"],
+                                                         node_id, False, transport, trace, deadline, output)
+                    data = entries[0] if entries else None
+                    run.setdefault("error", None if entries else "No output image")
+                except (DeadlineExceeded, JobCancelled):
+                    raise
+                except Exception as e:
+                    run["error"] = str(e)
+            if data is None:
+                print(f"Frame {run['index']} written unchanged: {run.get('error')}", file=sys.stderr)
                 sys.stderr.flush()
-        except Exception as e:
-            return {"status": "error", "error": f"Error retrieving images: {str(e)}"}
+                counts["failed_frames"] += 1
+                data = fallback_frame(run)
+            with trace.stage("write"):
+                emit(data, 1 + run["repeat"])
+            last_output = data
+        finally:
+            release_image_inputs(run["acquired"])
+            if run["owned"]:
+                os.remove(run["frame"])
+        if stream:
+            yield {"type": "frame", "index": run["index"], "repeated": run["repeat"],
+                   "status": "error" if run.get("error") else "success"}
 
-        return {
-            "status": "success",
-            "prompt_id": prompt_id,
-            "output_images": output_images,
-            "message": f"{len(output_images)} image(s) generated by node {node_id}."
-        }
+    try:
+        with tempfile.TemporaryDirectory(prefix="faceswap-sequence-") as workdir:
+            writer = open_sequence_writer(output_path, fps)
+            try:
+                for index, (frame_path, owned) in enumerate(iter_sequence_frames(sequence_path, workdir)):
+                    if index >= SEQUENCE_MAX_FRAMES:
+                        if owned:
+                            os.remove(frame_path)
+                        return {"status": "error", "error": f"Sequence too long (max {SEQUENCE_MAX_FRAMES} frames)",
+                                "output_path": output_path, **counts}
+                    if deadline.expired():
+                        if owned:
+                            os.remove(frame_path)
+                        return {**deadline.error(), "output_path": output_path, **counts}
+                    counts["frames"] += 1
+                    with trace.stage("fingerprint"):
+                        fingerprint = frame_fingerprint(frame_path)
+                    if last_fingerprint is not None and frame_distance(fingerprint, last_fingerprint) <= threshold:
+                        # Frame quasi identique à la dernière traitée: on réutilise sa sortie
+                        counts["reused_frames"] += 1
+                        if owned:
+                            os.remove(frame_path)
+                        if pending:
+                            pending[-1]["repeat"] += 1
+                        else:
+                            emit(last_output, 1)
+                        continue
+                    last_fingerprint = fingerprint
+                    counts["unique_frames"] += 1
+                    pending.append(submit(index, frame_path, owned))
+                    if stream and pending[-1]["prompt_id"]:
+                        yield {"type": "queued", "frame": index, "prompt_id": pending[-1]["prompt_id"]}
+                    # Pipeline: la collecte reste `window` prompts derrière la soumission
+                    while len(pending) > window:
+                        yield from collect(pending.popleft())
+                while pending:
+                    yield from collect(pending.popleft())
+            finally:
+                # Sortie anticipée: les prompts non collectés ne servent plus
+                for run in pending:
+                    if run["prompt_id"] is not None:
+                        run["instance"].events.unregister(run["prompt_id"])
+                        cancel_prompt(run["instance"], run["prompt_id"])
+                    release_image_inputs(run["acquired"])
+                pending.clear()
+                with trace.stage("write"):
+                    writer.close()
+    except (DeadlineExceeded, JobCancelled) as e:
+        error = execution_error(e, instance) if instance is not None else deadline.error()
+        return {**error, "output_path": output_path, **counts}
+    except (OSError, RuntimeError, subprocess.SubprocessError) as e:
+        return {"status": "error", "error": f"Error processing sequence: {str(e)}", "output_path": output_path, **counts}
+
+    if counts["frames"] == 0:
+        return {"status": "error", "error": f"No frames found in {sequence_path}", "output_path": output_path, **counts}
+    return {
+        "status": "success",
+        "output_path": output_path,
+        "fps": fps,
+        **counts,
+        "message": f"{counts['frames']} frame(s) written, {counts['unique_frames']} processed by ComfyUI."
+    }
+
+def run_job(job, cancelled: Optional[threading.Event] = None):
+    """Process one RunPod job synchronously and return its response."""
+    steps = iter_job(job, stream=False, cancelled=cancelled)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
 
+def warmup_comfyui(instance: ComfyInstance) -> bool:
+    """Run the default workflow once on `instance` so every loader node is resident in memory.
+
+    The prompt is derived from the configured workflow with the bundled sample
+    images and a single sampling step: it exercises every loader (UNET, CLIP,
+    VAE, upscaler, bbox/face-parsing models) at minimal GPU cost. Its output
+    files are deleted afterwards.
+    """
+    template = workflow_registry.get()
+    images = {"image1": os.path.abspath(WARMUP_IMAGE1), "image2": os.path.abspath(WARMUP_IMAGE2)}
+    missing = [path for path in images.values() if not os.path.exists(path)]
+    if missing:
+        print(f"Warmup skipped, images not found: {missing}", file=sys.stderr)
+        sys.stderr.flush()
+        return False
+    params = {"steps": 1} if "steps" in template.params else {}
+    _, prompt_id, events = submit_prompt(template.instantiate(images, params), instance=instance)
+    try:
+        wait_for_prompt(events, prompt_id, WARMUP_TIMEOUT)
+    finally:
+        instance.events.unregister(prompt_id)
+    instance.warm.set()
+    # Ne pas laisser l'image du warmup (SaveImage) dans le dossier output à chaque (re)démarrage
+    try:
+        entry = instance.client.get_json(f"/history/{prompt_id}", timeout=5).get(prompt_id) or {}
+        instance.remove_outputs(entry.get("outputs") or {})
     except Exception as e:
-        print(f"Unhandled error: {str(e)}", file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
+        print(f"Warmup output cleanup failed on {instance.name}: {str(e)}", file=sys.stderr)
         sys.stderr.flush()
-        return {
-            "status": "error",
-            "error": str(e),
-            "traceback": traceback.format_exc()
-        }
+    return True
+
+def _warmup_instance(instance: ComfyInstance) -> bool:
+    try:
+        return warmup_comfyui(instance)
+    except Exception as e:
+        print(f"Boot: warmup of {instance.name} failed: {str(e)}", file=sys.stderr)
+        sys.stderr.flush()
+        return False
 
-# Entry point for runpod.serverless - format conforme à la documentation RunPod
-runpod.serverless.start({"handler": handler})
+def boot() -> bool:
+    """Cold-start phase run before the worker accepts jobs.
 
-if __name__ == "__main__":
-    # Test local : charger test_input.json, appeler handler, afficher la sortie
-    import sys
-    import json
+    Starts the ComfyUI instances, then runs the warmup prompt on each of them
+    (in parallel) so the first real request sees warm-path latency wherever
+    it is routed. Phase durations are kept in BOOT_TIMINGS.
+    """
+    boot_start = time.monotonic()
+    if not start_comfyui():
+        BOOT_TIMINGS["comfyui_start"] = time.monotonic() - boot_start
+        print("Boot: ComfyUI failed to start, jobs will retry lazily", file=sys.stderr)
+        sys.stderr.flush()
+        return False
+    BOOT_TIMINGS["comfyui_start"] = time.monotonic() - boot_start
+    if WARMUP_ENABLED:
+        warmup_start = time.monotonic()
+        instances = comfy_pool.ready_instances()
+        with ThreadPoolExecutor(max_workers=max(1, len(instances)), thread_name_prefix="comfyui-warmup") as executor:
+            if any(list(executor.map(_warmup_instance, instances))):
+                models_loaded.set()
+        BOOT_TIMINGS["warmup"] = time.monotonic() - warmup_start
+    BOOT_TIMINGS["total"] = time.monotonic() - boot_start
+    print("Boot completed: " + ", ".join(f"{k}={v:.2f}s" for k, v in BOOT_TIMINGS.items()), file=sys.stderr)
+    sys.stderr.flush()
+    return models_loaded.is_set()
+
+async def handler(job):
+    """Main handler for RunPod Serverless jobs (faceswap via ComfyUI).
+
+    Async so RunPod can run several jobs at once on one worker: each job runs
+    in a thread and waits on the shared WebSocket, so ComfyUI's queue stays
+    fed while previous jobs fetch history and encode their outputs.
+    If RunPod cancels the request, the job's prompts are cancelled in ComfyUI.
+    """
+    cancelled = threading.Event()
+    try:
+        return await asyncio.to_thread(run_job, job, cancelled)
+    except asyncio.CancelledError:
+        # Le thread continue: il voit l'annulation et nettoie ses prompts
+        cancelled.set()
+        raise
+
+def _next_step(steps, lock: threading.Lock):
+    """Advance a job generator; returns (done, value)."""
+    with lock:
+        try:
+            return False, next(steps)
+        except StopIteration as stop:
+            return True, stop.value
+
+def _drain_steps(steps, lock: threading.Lock) -> None:
+    """Run a cancelled job generator to its end so it removes its prompts from ComfyUI."""
+    while not _next_step(steps, lock)[0]:
+        pass
+
+async def stream_handler(job):
+    """Streaming variant of `handler` (STREAM_OUTPUT=1).
+
+    Yields progress events ("queued", "started", "cached", "executing",
+    "progress"), then one "image" event per output image as soon as it is
+    available, and finally the job's response.
+    """
+    cancelled = threading.Event()
+    steps = iter_job(job, stream=True, cancelled=cancelled)
+    lock = threading.Lock()  # Un pas en cours dans son thread ne doit pas croiser le drain
+    try:
+        while True:
+            done, value = await asyncio.to_thread(_next_step, steps, lock)
+            yield value
+            if done:
+                return
+    except (asyncio.CancelledError, GeneratorExit):
+        # Requête annulée ou flux abandonné: finir le job en arrière-plan, il retire ses prompts
+        cancelled.set()
+        threading.Thread(target=_drain_steps, args=(steps, lock), name="cancelled-job-drain", daemon=True).start()
+        raise
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Number of jobs RunPod may hand to this worker at the same time.
+
+    At most MAX_CONCURRENCY, fewer when the ComfyUI instances could not get
+    through that many jobs within EXECUTION_TIMEOUT (see AdmissionController.capacity).
+    """
+    return admission.capacity(MAX_CONCURRENCY, EXECUTION_TIMEOUT)
+
+def start_worker() -> None:
+    """Boot ComfyUI and hand control to the RunPod serverless loop."""
+    # Cold start: ComfyUI + modèles chargés avant d'accepter le premier job
+    if EAGER_BOOT:
+        boot()
+
+    # Entry point for runpod.serverless - format conforme à la documentation RunPod
+    if STREAM_OUTPUT:
+        runpod.serverless.start({
+            "handler": stream_handler,
+            "concurrency_modifier": concurrency_modifier,
+            "return_aggregate_stream": True
+        })
+    else:
+        runpod.serverless.start({"handler": handler, "concurrency_modifier": concurrency_modifier})
+
+def run_local_test() -> None:
+    """Test local : charger test_input.json, appeler handler, afficher la sortie"""
     try:
         with open("test_input.json", "r", encoding="utf-8") as f:
             test_job = json.load(f)
         print("\n=== [LOCAL TEST] test_input.json loaded ===\n", file=sys.stderr)
         sys.stderr.flush()
-        result = handler(test_job)
+        result = run_job(test_job)
         print("\n=== [LOCAL TEST] Handler output ===\n", file=sys.stderr)
         print(json.dumps(result, indent=2, ensure_ascii=False))
         sys.stderr.flush()
     except Exception as e:
         print(f"[LOCAL TEST ERROR] {e}", file=sys.stderr)
-        import traceback
         print(traceback.format_exc(), file=sys.stderr)
         sys.stderr.flush()
-    sys.stderr.flush()
\ No newline at end of file
+    sys.stderr.flush()
+
+# Le worker ne démarre que lancé en script: le module reste importable (benchmarks)
+if __name__ == "__main__":
+    if "--local-test" in sys.argv:
+        run_local_test()
+    else:
+        start_worker()